@@ -17,7 +17,7 @@ DESCRIPTION = 'A Wander Linux builder implemented in Python .'
 URL = 'git@github.com:the-djdj/wander-py.git'
 EMAIL = 'jenkins.daniel.02@gmail.com'
 AUTHOR = 'the-djdj'
-REQUIRES_PYTHON = '>=3.6.0'
+REQUIRES_PYTHON = '>=3.9.0'
 VERSION = '0.1.0'
 
 # What packages are required for this module to be executed?
@@ -121,7 +121,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
+        'Programming Language :: Python :: 3.9',
         'Programming Language :: Python :: Implementation :: CPython',
         'Programming Language :: Python :: Implementation :: PyPy'
     ],
@@ -0,0 +1,81 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import path
+from threading import Lock, Thread
+
+import sys
+import unittest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'wander-py'))
+
+from stages.downloads import ConnectionPool
+
+
+class Counting(BaseHTTPRequestHandler):
+    ''' A handler which serves a small body for any path, noting the client
+        port of each connection that it's asked on.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.ports.add(self.client_address[1])
+
+        body = b'x' * 65536
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *arguments):
+        pass
+
+
+class ConnectionPoolTest(unittest.TestCase):
+    ''' Tests which check that the pool reuses connections to a local server.'''
+
+
+    def setUp(self):
+        ''' Starts the server, and creates the pool.'''
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Counting)
+        self.server.ports = set()
+        self.server.lock  = Lock()
+        Thread(target = self.server.serve_forever, daemon = True).start()
+
+        self.pool = ConnectionPool(30)
+        self.url  = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+
+
+    def tearDown(self):
+        ''' Closes the pool, and stops the server.'''
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def test_reuse(self):
+        ''' Several downloads from one host are served by a single connection.'''
+        for name in ('one', 'two', 'three'):
+            with self.pool.open(self.url + name) as response:
+                self.assertEqual(len(response.read()), 65536)
+
+        self.assertEqual(len(self.server.ports), 1)
+        self.assertEqual(self.pool.report()['127.0.0.1:{}'.format(self.server.server_address[1])]
+                            ['connections'], 1)
+
+
+    def test_unread(self):
+        ''' A connection whose response wasn't read isn't put back in the pool.'''
+        with self.pool.open(self.url + 'one') as response:
+            response.read(1)
+
+        self.assertFalse(any(self.pool.idle.values()))
+
+        with self.pool.open(self.url + 'two') as response:
+            response.read()
+
+        self.assertEqual(len(self.server.ports), 2)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+from hashlib import md5
+from http.client import HTTPConnection
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from functools import partial
+from os import makedirs, path
+from tempfile import TemporaryDirectory
+from threading import Thread
+
+import sys
+import unittest
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), '..', 'wander-py'))
+
+from mirror import Mirror
+from stages.downloads import Downloader
+
+
+class Upstream(SimpleHTTPRequestHandler):
+    ''' A handler which serves the upstream files quietly.'''
+
+    def log_message(self, format, *arguments):
+        pass
+
+
+class MirrorTest(unittest.TestCase):
+    ''' Tests which run the mirror against a local upstream server.'''
+
+
+    def setUp(self):
+        ''' Creates an upstream with one file, a distribution which uses it and
+            a mirror which serves it.'''
+        self.directory = TemporaryDirectory()
+        root = self.directory.name
+
+        # Create the upstream, with a file on it
+        makedirs(path.join(root, 'upstream'))
+        self.data = bytes(range(256)) * 64
+
+        with open(path.join(root, 'upstream', 'hello-1.0.tar.gz'), 'wb') as file:
+            file.write(self.data)
+
+        self.upstream = ThreadingHTTPServer(('127.0.0.1', 0),
+                                            partial(Upstream, directory = path.join(root, 'upstream')))
+        Thread(target = self.upstream.serve_forever, daemon = True).start()
+
+        # Create the distribution which uses the file
+        self.digest = md5(self.data).hexdigest()
+        dist        = path.join(root, 'dist')
+        makedirs(dist)
+
+        with open(path.join(dist, '__metadata.yaml'), 'w') as file:
+            file.write('stages: {{}}\ndownloads:\n    store: {}\n    retries: 1\n    backoff: 0\n'
+                       .format(path.join(root, 'store')))
+
+        with open(path.join(dist, 'packages.yaml'), 'w') as file:
+            file.write('preamble:\n    WANDER: {}\nelements:\n    hello:\n        description: Hello\n'
+                       '        version: "1.0"\n        file: hello-{{version}}\n'
+                       '        extension: .tar.gz\n        url: http://127.0.0.1:{}/\n'
+                       '        md5: {}\n'.format(path.join(root, 'wander'),
+                                                  self.upstream.server_address[1], self.digest))
+
+        with open(path.join(dist, 'patches.yaml'), 'w') as file:
+            file.write('preamble:\n    WANDER: {}\nelements: {{}}\n'.format(path.join(root, 'wander')))
+
+        # And serve it from the mirror
+        self.mirror = Mirror([Downloader(dist)], '127.0.0.1', 0)
+        self.thread = Thread(target = self.mirror.verify, daemon = True)
+        self.thread.start()
+
+
+    def tearDown(self):
+        ''' Stops the servers and removes their files.'''
+        self.mirror.stop()
+        self.thread.join()
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        self.directory.cleanup()
+
+
+    def get(self, location, headers = None):
+        ''' Makes a request of the mirror, returning the status, headers and body.'''
+        connection = HTTPConnection(*self.mirror.server.server_address[:2], timeout = 30)
+        connection.request('GET', location, headers = headers or dict())
+        response = connection.getresponse()
+        result   = response.status, response.headers, response.read()
+        connection.close()
+        return result
+
+
+    def test_fetch_on_miss(self):
+        ''' A file which isn't in the store is fetched from upstream, kept and served.'''
+        status, _, body = self.get('/md5/{}/hello-1.0.tar.gz'.format(self.digest))
+
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.data)
+        self.assertTrue(path.isfile(path.join(self.directory.name, 'store', 'md5',
+                                              self.digest[:2], self.digest)))
+
+
+    def test_range(self):
+        ''' A range of a file is sent as a partial response.'''
+        status, headers, body = self.get('/md5/{}/hello-1.0.tar.gz'.format(self.digest),
+                                         {'Range': 'bytes=100-199'})
+
+        self.assertEqual(status, 206)
+        self.assertEqual(headers.get('Content-Range'), 'bytes 100-199/{}'.format(len(self.data)))
+        self.assertEqual(body, self.data[100:200])
+
+
+    def test_unknown(self):
+        ''' A file which no distribution uses isn't found.'''
+        status, _, _ = self.get('/md5/{}/other.tar.gz'.format('0' * 32))
+
+        self.assertEqual(status, 404)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+from os import path
+from shutil import which
+from subprocess import DEVNULL, PIPE, Popen
+from time import monotonic as clock
+
+import tarfile
+
+
+class Archive:
+    ''' The archive class. This extracts a tarball, decompressing it with a
+        separate program where one is installed, so that the decompression can
+        use several cores and runs alongside the extraction. Python's tarfile
+        module is used to decompress the archive when no program is found.'''
+
+
+    # The programs which decompress each kind of archive, fastest first
+    DECOMPRESSORS = {'.zst': [['zstd', '-T0', '-d', '-q', '-c']],
+                     '.xz':  [['xz', '-T0', '-d', '-c']],
+                     '.gz':  [['pigz', '-d', '-c'], ['gzip', '-d', '-c']],
+                     '.tgz': [['pigz', '-d', '-c'], ['gzip', '-d', '-c']],
+                     '.bz2': [['lbzip2', '-d', '-c'], ['pbzip2', '-d', '-c'], ['bzip2', '-d', '-c']]}
+
+
+    def __init__(self, filename, extension = None, logger = None):
+        ''' The constructor. This creates a new archive object for a file, whose
+            compression is given by its extension.'''
+        # Store the file which holds the archive
+        self.filename  = filename
+        self.extension = extension if extension is not None else path.basename(filename)
+
+        # Store where the extraction is logged
+        self.logger    = logger
+
+
+    def program(self):
+        ''' A method which returns the command of the fastest program installed
+            which can decompress the archive, or None if there isn't one.'''
+        # Get the programs which can decompress this kind of archive
+        programs = Archive.DECOMPRESSORS.get(path.splitext(self.extension)[1], list())
+
+        # And return the first one which is installed
+        return next((program for program in programs if which(program[0]) is not None), None)
+
+
+    def decompress(self, output):
+        ''' A method which starts decompressing the archive into an output, and
+            returns the process doing so, or None if no program can.'''
+        # Get the program which decompresses the archive
+        program = self.program()
+
+        # Check that there is one
+        if program is None:
+            return None
+
+        # And start it
+        return Popen(program + [self.filename], stdout = output, stderr = DEVNULL)
+
+
+    def extract(self, directory, strip = 0, owner = None):
+        ''' A method which extracts the archive into a directory in a single
+            pass, logging how it was done and how long it took, and returns if
+            it worked. A number of leading folders can be stripped from each
+            member, and each member can be given to an owner as it's written.'''
+        # Note when the extraction started
+        start = clock()
+
+        # Start decompressing the archive
+        process = self.decompress(PIPE)
+
+        # Check if the archive has to be decompressed by tarfile instead
+        if process is None:
+
+            # Extract the archive
+            with tarfile.open(self.filename) as contents:
+                contents.extractall(directory, self.members(contents, strip, owner),
+                                    numeric_owner = owner is not None)
+
+            # Note how it was done
+            command, result = 'tarfile ' + self.filename, True
+
+        else:
+
+            try:
+                # Extract the archive as it's decompressed
+                with tarfile.open(fileobj = process.stdout, mode = 'r|') as contents:
+                    contents.extractall(directory, self.members(contents, strip, owner),
+                                        numeric_owner = owner is not None)
+
+                # Read whatever is left, so that the decompressor can finish
+                while process.stdout.read(65536):
+                    pass
+
+            # This is thrown if the archive couldn't be extracted
+            except Exception:
+
+                # So stop decompressing it, as the rest isn't needed
+                process.kill()
+                process.wait()
+
+                raise
+
+            # Note how it was done, and if the decompression worked
+            command, result = ' '.join(process.args) + ' | tarfile', process.wait() == 0
+
+        # Log the extraction, if there's somewhere to do so
+        if self.logger is not None:
+            self.logger.log('unpacking', command,
+                            ('{} in {:.2f} seconds'.format('Extracted' if result else 'Failed',
+                                                           clock() - start).encode('utf-8'), None))
+
+        # And return if the extraction worked
+        return result
+
+
+    def scan(self, directory = None, names = ()):
+        ''' A method which reads through the whole archive, checking that it
+            decompresses and ends cleanly, and returns the top folders of its
+            members. Any of the members which are named, without their top
+            folder, are extracted into a directory so that they can be checked.
+            An exception is thrown if the archive is damaged.'''
+        # Start decompressing the archive
+        process = self.decompress(PIPE)
+
+        try:
+            # Open the archive as a stream, so that it's only read once
+            contents = tarfile.open(fileobj = process.stdout, mode = 'r|') if process is not None \
+                        else tarfile.open(self.filename, mode = 'r|*')
+
+            # Store the top folders of the members
+            folders = set()
+
+            with contents:
+
+                # Iterate through each of the members
+                for member in contents:
+
+                    # Split the name of the member into its folders
+                    parts = [part for part in member.name.split('/') if part not in ('', '.')]
+
+                    # Add its top folder
+                    folders.update(parts[:1])
+
+                    # Check if the member is one that we've been asked for
+                    if directory is not None and member.isreg() and '/'.join(parts[1:]) in names:
+
+                        # And extract it without its top folder
+                        member.name = '/'.join(parts[1:])
+                        contents.extract(member, directory)
+
+                # Note where the archive should have ended
+                end = contents.offset + tarfile.BLOCKSIZE
+
+                # Read whatever is left
+                while contents.fileobj.read(65536):
+                    pass
+
+                # Get what tarfile used to decompress the archive, if anything
+                decompressor = getattr(contents.fileobj, 'cmp', None)
+
+                # Check that the end of the archive was reached, not the end of the data
+                if contents.fileobj.pos < end or not getattr(decompressor, 'eof', True):
+                    raise tarfile.ReadError('{} ends unexpectedly'.format(self.filename))
+
+        # This is thrown if the archive is damaged
+        except Exception:
+
+            # So stop decompressing it, as the rest isn't needed
+            if process is not None:
+                process.kill()
+                process.wait()
+
+            raise
+
+        # Check that the archive was decompressed without errors
+        if process is not None and process.wait() != 0:
+            raise tarfile.ReadError('{} could not be decompressed'.format(self.filename))
+
+        # And return the top folders
+        return folders
+
+
+    def members(self, contents, strip, owner):
+        ''' A generator which returns each of the members of the archive as it
+            is read, with its leading folders stripped and its owner changed.'''
+        # Iterate through each of the members
+        for member in contents:
+
+            # Split the name of the member into its folders
+            parts = [part for part in member.name.split('/') if part not in ('', '.')]
+
+            # Skip the folders which are being stripped
+            if len(parts) <= strip:
+                continue
+
+            # Remove the leading folders from the name
+            member.name = '/'.join(parts[strip:])
+
+            # And from the target of a hard link, which is also in the archive
+            if member.islnk():
+                member.linkname = '/'.join([part for part in member.linkname.split('/')
+                                                if part not in ('', '.')][strip:])
+
+            # Check if the member should be given to someone
+            if owner is not None:
+
+                # And give it to them
+                member.uid, member.gid = owner
+                member.uname, member.gname = '', ''
+
+            # And return the member
+            yield member
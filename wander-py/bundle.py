@@ -0,0 +1,258 @@
+from hashlib import new as hasher
+from mmap import mmap, ACCESS_READ
+from os import makedirs, path, replace as rename
+from struct import Struct
+from threading import Lock
+from util import Output
+from yaml import safe_dump as dump, safe_load as load, YAMLError
+
+
+class Bundle:
+    ''' The bundle class. A bundle is a single file holding every archive and
+        patch that a distribution uses, so that builders without network
+        access can be seeded. The file begins with a header and an index of
+        the name, offset, size and checksum of each entry, and each entry is
+        aligned so that it can be read straight out of a memory map.'''
+
+
+    # The bytes which mark the start of a bundle
+    MAGIC     = b'WANDERBN'
+
+    # The layout of the header: the magic bytes, the version, and the size of
+    # the index which follows it
+    HEADER    = Struct('<8sII')
+
+    # The version of the bundle format
+    VERSION   = 1
+
+    # The boundary on which each entry begins
+    ALIGNMENT = 4096
+
+
+    def __init__(self, filename):
+        ''' The constructor. This creates a new bundle object, which is read
+            from the disk the first time that it's needed.'''
+        # Store where the bundle is kept
+        self.filename = filename
+
+        # Create a placeholder for the contents of the bundle
+        self.map     = None
+        self.index   = None
+        self.lock    = Lock()
+
+
+    def open(self):
+        ''' A method which maps the bundle into memory and reads its index, if
+            this hasn't already been done.'''
+        # Make sure that only one thread opens the bundle
+        with self.lock:
+
+            # Check if the bundle has already been opened
+            if self.index is not None:
+                return self.index
+
+            # Open the file and map it into memory
+            with open(self.filename, 'rb') as file:
+                self.map = mmap(file.fileno(), 0, access = ACCESS_READ)
+
+            # Read the header
+            magic, version, size = Bundle.HEADER.unpack_from(self.map, 0)
+
+            # Check that this really is a bundle that we can read
+            if magic != Bundle.MAGIC or version != Bundle.VERSION:
+                raise ValueError('{} is not a Wander bundle'.format(self.filename))
+
+            # Read the index
+            try:
+                entries = load(self.map[Bundle.HEADER.size:Bundle.HEADER.size + size].decode('utf-8'))
+
+            # If the index is damaged, the bundle can't be used
+            except YAMLError:
+                raise ValueError('{} has a damaged index'.format(self.filename))
+
+            # Work out where the entries begin
+            start = self.align(Bundle.HEADER.size + size)
+
+            # And store the index by checksum
+            self.index = {(entry['algorithm'], entry['digest']):
+                            dict(entry, offset = start + entry['offset'])
+                                for entry in entries}
+
+            return self.index
+
+
+    def find(self, algorithm, digest):
+        ''' A method which returns the contents of an entry in the bundle as a
+            memory view, without copying it, or None if it isn't there.'''
+        # Get the entry from the index
+        entry = self.open().get((algorithm, digest))
+
+        # Check that the entry exists
+        if entry is None:
+            return None
+
+        # And return a view of its contents
+        return memoryview(self.map)[entry['offset']:entry['offset'] + entry['size']]
+
+
+    def export(self, downloader):
+        ''' A method which writes every package and patch which a distribution
+            uses into the bundle.'''
+        # Tell the user what's happening
+        Output.header('Writing bundle {}...'.format(self.filename))
+
+        # Store the result of the export
+        result = True
+
+        # Store the entries in the bundle, and the files that they come from
+        entries = list()
+        sources = list()
+
+        # Store where the next entry goes
+        offset = 0
+
+        # Iterate through each of the packages and patches
+        for downloads in (downloader.packages, downloader.patches):
+            for download in downloads.downloads.values():
+
+                # Note that we've started on the file
+                Output.log(Output.SCANNING, download.description)
+
+                # Check that the file is in the store
+                success = download.checksum()
+                result &= success
+
+                # Check that the file hasn't already been added
+                if success and (download.algorithm, download.digest) not in \
+                        [(entry['algorithm'], entry['digest']) for entry in entries]:
+
+                    # Get the size of the file
+                    size = path.getsize(download.source)
+
+                    # And add it to the index
+                    entries.append({'name':      download.file + download.extension,
+                                    'algorithm': download.algorithm,
+                                    'digest':    download.digest,
+                                    'offset':    offset,
+                                    'size':      size})
+                    sources.append(download.source)
+
+                    # And move on to the next boundary
+                    offset = self.align(offset + size)
+
+                # And tell the user how it went
+                Output.clear()
+                Output.log(Output.PASSED if success else Output.FAILED, download.description)
+                print('')
+
+        # Create the index
+        index = dump(entries).encode('utf-8')
+
+        # Work out where the entries begin
+        start = self.align(Bundle.HEADER.size + len(index))
+
+        # Write to a temporary file, so that the bundle is never half written
+        with open(self.filename + '.part', 'wb') as file:
+
+            # Write the header and the index
+            file.write(Bundle.HEADER.pack(Bundle.MAGIC, Bundle.VERSION, len(index)))
+            file.write(index)
+
+            # Iterate through each of the entries
+            for entry, source in zip(entries, sources):
+
+                # Move to where the entry begins
+                file.seek(start + entry['offset'])
+
+                # And copy the file in
+                with open(source, 'rb') as input:
+                    while True:
+
+                        # Read in a chunk of data
+                        data = input.read(1048576)
+
+                        # Check that that chunk is not empty
+                        if not data:
+                            break
+
+                        # And write it to the bundle
+                        file.write(data)
+
+            # Make sure that the last entry is padded out
+            file.truncate(start + offset)
+
+        # And move the bundle into place
+        rename(self.filename + '.part', self.filename)
+
+        # Inform the user of the status
+        Output.footer(result, 'Writing bundle {}'.format(self.filename))
+
+        # And return the result
+        return result
+
+
+    def unpack(self, downloader):
+        ''' A method which verifies every entry in the bundle and copies it into
+            the store, so that it is available to every distribution.'''
+        # Tell the user what's happening
+        Output.header('Reading bundle {}...'.format(self.filename))
+
+        # Store the result of the import
+        result = True
+
+        # Iterate through each of the entries in the bundle
+        for (algorithm, digest), entry in self.open().items():
+
+            # Note that we've started on the entry
+            Output.log(Output.VERIFYING, entry['name'])
+
+            # Work out where the entry goes in the store
+            target = path.join(downloader.store, algorithm, digest[:2], digest)
+
+            # Check if the store already has a good copy
+            success = downloader.manifest.lookup(target, algorithm) == digest
+
+            # Otherwise copy the entry into the store
+            if not success:
+
+                # Get the contents of the entry
+                data = self.find(algorithm, digest)
+
+                # Check that the entry is intact
+                success = hasher(algorithm, data).hexdigest() == digest
+
+                # And copy it into the store if it is
+                if success:
+
+                    # Make sure there's somewhere to put the file
+                    makedirs(path.dirname(target), exist_ok = True)
+
+                    # Write the file
+                    with open(target + '.part', 'wb') as file:
+                        file.write(data)
+
+                    # And move it into place
+                    rename(target + '.part', target)
+                    downloader.manifest.record(target, algorithm, digest)
+
+            # Add the result to our results variable
+            result &= success
+
+            # And tell the user how it went
+            Output.clear()
+            Output.log(Output.PASSED if success else Output.FAILED, entry['name'])
+            print('')
+
+        # Remember what we verified for next time
+        downloader.manifest.save()
+
+        # Inform the user of the status
+        Output.footer(result, 'Reading bundle {}'.format(self.filename))
+
+        # And return the result
+        return result
+
+
+    def align(self, offset):
+        ''' A method which rounds an offset up to the next boundary.'''
+        return -(-offset // Bundle.ALIGNMENT) * Bundle.ALIGNMENT
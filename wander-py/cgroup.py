@@ -0,0 +1,312 @@
+from atexit import register
+from os import close, getpid, mkdir, O_DIRECTORY, O_RDONLY, O_WRONLY, open as openfd, path, \
+               pread, rmdir, write
+from util import Output
+
+
+class Cgroups:
+    ''' The cgroups class. This creates a cgroup v2 subtree for the build, in
+        which each module is given a cgroup of its own, so that the processor
+        time, memory and disk that a module uses can be limited and measured
+        apart from the rest of the host. The subtree is opened before the build
+        enters the chroot, so that it can still be used inside it. Where there
+        are no cgroups that we can use, modules are simply built without them.'''
+
+
+    # Where the cgroup v2 hierarchy is mounted, in the order that it's looked for
+    MOUNTS = ['/sys/fs/cgroup', '/sys/fs/cgroup/unified']
+
+    # The controllers which modules are limited and measured with
+    CONTROLLERS = ['cpu', 'memory', 'io']
+
+    # The cgroup within the subtree which the build itself runs in
+    SELF = 'wander'
+
+
+    def __init__(self):
+        ''' The constructor. This creates the build's subtree within the cgroup
+            that the build is in, moves the build itself into a cgroup of its
+            own within the subtree, as a cgroup with processes in it can't hand
+            controllers down, and turns on whichever controllers it can.'''
+        # Store the subtree, and the controllers turned on within it
+        self.directory   = None
+        self.controllers = set()
+
+        # Store the controllers which we turned on in the cgroup that we're in
+        self.enabled     = set()
+
+        # Get the cgroup that we're in, and where the hierarchy is mounted
+        location = self.locate()
+        mount    = next((mount for mount in Cgroups.MOUNTS
+                            if path.isfile(path.join(mount, 'cgroup.controllers'))), None)
+
+        # Check that there's a cgroup v2 hierarchy to use
+        if location is None or mount is None:
+            Output.text('Warning: cgroup v2 is not available, so modules are built without limits.')
+            return
+
+        # Get where the cgroup is, and where the subtree goes
+        parent  = path.join(mount, location.strip('/'))
+        self.name = 'wander-{}'.format(getpid())
+
+        try:
+            # Create the subtree, and open it
+            mkdir(path.join(parent, self.name))
+            self.directory = openfd(path.join(parent, self.name), O_RDONLY | O_DIRECTORY)
+
+            # Open the cgroup that we're in, so that the subtree can be removed
+            self.parent = openfd(parent, O_RDONLY | O_DIRECTORY)
+
+            # Create the cgroup which the build itself runs in, and move into it
+            mkdir(Cgroups.SELF, dir_fd = self.directory)
+            self.write(self.directory, path.join(Cgroups.SELF, 'cgroup.procs'), getpid())
+
+        # This is thrown if we aren't allowed to create cgroups
+        except OSError as error:
+
+            # So remove whatever was created
+            for directory in (path.join(parent, self.name, Cgroups.SELF), path.join(parent, self.name)):
+                try:
+                    rmdir(directory)
+
+                # This is thrown if it wasn't created
+                except OSError:
+                    pass
+
+            # And tell the user, and carry on without them
+            Output.text('Warning: cgroups can\'t be created ({}), so modules are built '
+                        'without limits.'.format(error.strerror))
+
+            self.directory = None
+            return
+
+        # Iterate through each of the controllers
+        for controller in Cgroups.CONTROLLERS:
+
+            try:
+                # Turn the controller on in the cgroup that we're in, for the subtree
+                if controller not in self.read(self.parent, 'cgroup.subtree_control').split():
+                    self.write(self.parent, 'cgroup.subtree_control', '+' + controller)
+                    self.enabled.add(controller)
+
+                # And in the subtree, for the cgroups of the modules
+                self.write(self.directory, 'cgroup.subtree_control', '+' + controller)
+
+                # And note that it's on
+                self.controllers.add(controller)
+
+            # This is thrown if the controller can't be turned on, such as when
+            # other processes share the cgroup that we're in
+            except OSError:
+                pass
+
+        # Tell the user which controllers couldn't be turned on
+        if self.controllers != set(Cgroups.CONTROLLERS):
+            Output.text('Warning: the {} cgroup controllers couldn\'t be turned on, so their '
+                        'limits won\'t be applied.'.format(', '.join(controller
+                            for controller in Cgroups.CONTROLLERS if controller not in self.controllers)))
+
+        # And remove the subtree when the build ends
+        register(self.close)
+
+
+    def locate(self):
+        ''' A method which returns the location of the cgroup v2 cgroup that
+            we're in, or None if we aren't in one.'''
+        try:
+            # Read the cgroups that we're in
+            with open('/proc/self/cgroup', 'r') as stream:
+
+                # And return the one in the cgroup v2 hierarchy
+                return next((line.split(':', 2)[2].strip() for line in stream
+                                if line.startswith('0::')), None)
+
+        # This is thrown if there are no cgroups
+        except OSError:
+            return None
+
+
+    def read(self, directory, name):
+        ''' A method which reads a file of a cgroup.'''
+        # Open the file
+        descriptor = openfd(name, O_RDONLY, dir_fd = directory)
+
+        try:
+            # And read it
+            return pread(descriptor, 65536, 0).decode('utf-8', 'replace')
+
+        finally:
+            close(descriptor)
+
+
+    def write(self, directory, name, value):
+        ''' A method which writes a value to a file of a cgroup.'''
+        # Open the file
+        descriptor = openfd(name, O_WRONLY, dir_fd = directory)
+
+        try:
+            # And write the value
+            write(descriptor, str(value).encode('utf-8'))
+
+        finally:
+            close(descriptor)
+
+
+    def create(self, name, limits):
+        ''' A method which creates the cgroup of a module, with some limits, and
+            returns it, or None if cgroups can't be used.'''
+        # Check that there's a subtree to create it in
+        if self.directory is None:
+            return None
+
+        try:
+            # Create the cgroup
+            return Cgroup(self, name, limits)
+
+        # This is thrown if the cgroup couldn't be created
+        except OSError:
+            return None
+
+
+    def close(self):
+        ''' A method which removes the build's subtree once the build ends,
+            turning off the controllers that we turned on and moving the build
+            back to the cgroup that it started in.'''
+        # Turn off the controllers, in the subtree and then above it
+        steps  = [(self.write, (directory, 'cgroup.subtree_control', '-' + controller))
+                    for directory, controllers in [(self.directory, self.controllers),
+                                                   (self.parent, self.enabled)]
+                    for controller in controllers]
+
+        # Move back to the cgroup that we started in, and remove the subtree
+        steps += [(self.write, (self.parent, 'cgroup.procs', getpid())),
+                  (lambda name, directory: rmdir(name, dir_fd = directory), (Cgroups.SELF, self.directory)),
+                  (lambda name, directory: rmdir(name, dir_fd = directory), (self.name, self.parent))]
+
+        # Iterate through each of the steps
+        for step, arguments in steps:
+
+            try:
+                # And take it
+                step(*arguments)
+
+            # This is thrown if the step couldn't be taken, so we carry on with the rest
+            except OSError:
+                pass
+
+
+
+class Cgroup:
+    ''' The cgroup class, which limits and measures the processes of a single
+        module.'''
+
+
+    def __init__(self, parent, name, limits):
+        ''' The init method, used to create the cgroup of a module and apply its
+            limits. Limits which can't be applied, such as those for controllers
+            which aren't on, are noted so that the user can be told.'''
+        # Store the subtree, and the name of the cgroup within it
+        self.parent = parent
+        self.name   = name
+
+        # Create the cgroup, removing any left from an earlier attempt
+        try:
+            rmdir(self.name, dir_fd = parent.directory)
+
+        # This is thrown if there was no cgroup left
+        except OSError:
+            pass
+
+        mkdir(self.name, dir_fd = parent.directory)
+
+        # Open the cgroup
+        self.directory = openfd(self.name, O_RDONLY | O_DIRECTORY, dir_fd = parent.directory)
+
+        # Store the limits which were applied, and those which couldn't be
+        self.limits  = dict()
+        self.skipped = dict()
+
+        # Iterate through each of the limits
+        for limit, value in (limits or dict()).items():
+
+            try:
+                # Check that the controller of the limit is on
+                if limit.split('.')[0] not in parent.controllers:
+                    raise OSError
+
+                # Apply the limit
+                parent.write(self.directory, limit, value)
+                self.limits[limit] = value
+
+            # This is thrown if the limit couldn't be applied
+            except OSError:
+                self.skipped[limit] = value
+
+        # Open the file which moves processes into the cgroup
+        self.procs = openfd('cgroup.procs', O_WRONLY, dir_fd = self.directory)
+
+
+    def enter(self, pid):
+        ''' A method which moves a process into the cgroup, used for each
+            command before it's allowed to start.'''
+        try:
+            # Move the process
+            write(self.procs, str(pid).encode('utf-8'))
+
+        # This is thrown if the process can't be moved, so it's built without it
+        except OSError:
+            pass
+
+
+    def usage(self):
+        ''' A method which returns the processor time, memory and disk used by
+            the processes of the cgroup.'''
+        # Store what was used
+        usage = dict()
+
+        # Read each of the measurements which are available
+        for name in ('cpu.stat', 'memory.peak', 'io.stat'):
+
+            try:
+                # Read the measurement
+                contents = self.parent.read(self.directory, name)
+
+            # This is thrown if the measurement isn't available
+            except OSError:
+                continue
+
+            # Check if this is the processor time, in microseconds
+            if name == 'cpu.stat':
+                for line in contents.split('\n'):
+                    if line.split(' ')[0] in ('usage_usec', 'user_usec', 'system_usec'):
+                        usage['cpu.' + line.split(' ')[0]] = int(line.split(' ')[1])
+
+            # Check if this is the most memory used, in bytes
+            elif name == 'memory.peak':
+                usage['memory.peak'] = int(contents.strip())
+
+            # Otherwise this is the disk used, by device, so add it up
+            else:
+                for line in contents.split('\n'):
+                    for field in line.split()[1:]:
+                        if field.split('=')[0] in ('rbytes', 'wbytes'):
+                            key = 'io.' + field.split('=')[0]
+                            usage[key] = usage.get(key, 0) + int(field.split('=')[1])
+
+        # And return what was used
+        return usage
+
+
+    def remove(self):
+        ''' A method which removes the cgroup, once the module has finished.'''
+        # Close the cgroup
+        close(self.procs)
+        close(self.directory)
+
+        try:
+            # And remove it
+            rmdir(self.name, dir_fd = self.parent.directory)
+
+        # This is thrown if something is still running within it
+        except OSError:
+            pass
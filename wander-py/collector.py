@@ -0,0 +1,295 @@
+from glob import glob
+from hashlib import algorithms_guaranteed
+from os import getpid, kill, listdir, lstat, path, remove as deletefile, rmdir, walk
+from shutil import rmtree
+from util import Output
+from yaml import safe_load as load, YAMLError
+
+
+class Collector:
+    ''' The collector class. This removes the archives and patches in the store
+        which none of the installed distributions use any more, along with the
+        copies of them in the build system, so that the store doesn't grow for
+        ever. Unused files are removed oldest first, by the time that they were
+        last verified, until the store fits within its size cap.'''
+
+
+    def __init__(self, downloader, cap):
+        ''' The constructor. This creates a new collector for the store of a
+            distribution's downloader.'''
+        # Store the downloader which owns the store
+        self.downloader = downloader
+
+        # Store the size, in bytes, that the store should fit within
+        self.cap        = cap
+
+
+    def verify(self):
+        ''' A method which collects the store, telling the user what was
+            removed and how much space was reclaimed.'''
+        # Tell the user what's happening
+        Output.header('Collecting unused sources in {}...'.format(path.realpath(self.downloader.store)))
+
+        # Remove the files which aren't needed
+        removed, reclaimed = self.collect(True)
+
+        # Remember what's left for next time
+        self.downloader.manifest.save()
+
+        # Tell the user how much space was reclaimed
+        Output.text('Removed {} files, reclaiming {:.2f} MiB.'.format(removed, reclaimed / 1048576))
+
+        # Inform the user of the status
+        Output.footer(True, 'Collecting unused sources')
+
+        # And return that everything went well
+        return True
+
+
+    def collect(self, verbose = False):
+        ''' A method which removes unused files, oldest first, until the store
+            fits within its size cap, and returns the number of files removed
+            and the number of bytes reclaimed.'''
+        try:
+            # Get the files which are still in use
+            checksums, names = self.references()
+
+        # This is thrown if we can't tell, in which case everything is kept
+        except ValueError as error:
+
+            # Tell the user why nothing was removed
+            if verbose:
+                Output.text(str(error))
+
+            return 0, 0
+
+        # Store the files which could be removed, and the size of the store
+        candidates = list()
+        total      = 0
+
+        # Iterate through each of the files in the store
+        for filename, key in self.files():
+
+            # Get the size of the file
+            size   = lstat(filename).st_size
+            total += size
+
+            # Check that the file isn't in use
+            if key in checksums or (key is None and path.basename(filename) in names):
+                continue
+
+            # And add it to the candidates, by when it was last verified
+            candidates.append((self.verified(filename), filename, key, size))
+
+        # Store how much was removed
+        removed, reclaimed = 0, 0
+
+        # Iterate through each of the candidates, oldest first
+        for _, filename, key, size in sorted(candidates):
+
+            # Check if the store is now small enough
+            if total <= self.cap:
+                break
+
+            # Tell the user what's being removed
+            if verbose:
+                Output.text('Removing {}'.format(filename))
+
+            # Remove the file, and each of its copies
+            for copy in [filename] + self.copies(key, names):
+                reclaimed += self.remove(copy)
+                removed   += 1
+
+            try:
+                # Remove the directory that held the file, if it's now empty
+                if key is not None:
+                    rmdir(path.dirname(filename))
+
+            # This is thrown if the directory still holds other files
+            except OSError:
+                pass
+
+            # And note that the store is now smaller
+            total -= size
+
+        # And return how much was removed
+        return removed, reclaimed
+
+
+    def references(self):
+        ''' A method which returns the checksums and names of every file used
+            by the installed distributions, and by the builds which are running.'''
+        # Store the checksums and names of the files
+        checksums = set()
+        names     = set()
+
+        # Iterate through the packages and patches of each distribution
+        for filename in glob(path.join(self.downloader.location, '..', '*', '*.yaml')):
+
+            # Check that the file lists downloads
+            if path.basename(filename) not in ('packages.yaml', 'patches.yaml'):
+                continue
+
+            # Load the YAML file
+            with open(filename, 'r') as stream:
+
+                # Read from the stream
+                try:
+
+                    # Store the file contents
+                    elements = (load(stream) or dict()).get('elements') or dict()
+
+                # If the file is damaged, we can't tell what it uses, so keep everything
+                except YAMLError:
+                    raise ValueError('{} could not be read'.format(filename))
+
+            # Iterate through each of the files listed
+            for element in elements.values():
+
+                # Add each of its checksums
+                checksums |= {(algorithm, str(digest).lower()) for algorithm, digest in element.items()
+                                if algorithm in algorithms_guaranteed}
+
+                # And its name
+                names.add(str(element.get('file')).replace('{version}', str(element.get('version')))
+                            + str(element.get('extension')))
+
+        # Add the files pinned by running builds
+        checksums |= self.pins()
+
+        # And return what we found
+        return checksums, names
+
+
+    def pins(self):
+        ''' A method which returns the checksums of the files which running
+            builds have pinned, removing the pins of builds which have ended.'''
+        # Store the checksums of the pinned files
+        checksums = set()
+
+        # Iterate through each of the pins
+        for filename in glob(path.join(self.downloader.store, '.pins', '*.yaml')):
+
+            # Get the process which owns the pin
+            pid = int(path.basename(filename)[:-len('.yaml')])
+
+            try:
+                # Check that the process is still running
+                if pid != getpid():
+                    kill(pid, 0)
+
+            # This is thrown if the process has ended, so the pin can go
+            except ProcessLookupError:
+                deletefile(filename)
+                continue
+
+            # This is thrown if the process belongs to someone else
+            except PermissionError:
+                pass
+
+            # Load the YAML file
+            with open(filename, 'r') as stream:
+
+                # Read from the stream
+                try:
+
+                    # And add each of the pinned files
+                    checksums |= {tuple(pin) for pin in load(stream) or list()}
+
+                # If the pin is damaged, we can't tell what it holds, so keep everything
+                except YAMLError:
+                    raise ValueError('{} could not be read'.format(filename))
+
+        # And return the pinned files
+        return checksums
+
+
+    def files(self):
+        ''' A method which returns each of the files in the store, along with
+            the checksum that it is kept under, if it has one.'''
+        # Store the files that we find
+        files = list()
+
+        # Iterate through each of the items in the store
+        for algorithm in listdir(self.downloader.store):
+
+            # Get the full path of the item
+            directory = path.join(self.downloader.store, algorithm)
+
+            # Check if this is a file left from before there was a store
+            if path.isfile(directory) and not algorithm.startswith('.'):
+                files.append((directory, None))
+
+            # Check that this is one of the checksums that files are kept under
+            if not path.isdir(directory) or algorithm not in algorithms_guaranteed:
+                continue
+
+            # Iterate through each of the files kept under the checksum
+            for filename in glob(path.join(directory, '*', '*')):
+
+                # And add the file, ignoring anything after the checksum itself
+                files.append((filename, (algorithm, path.basename(filename).split('.')[0])))
+
+        # And return the files
+        return files
+
+
+    def verified(self, filename):
+        ''' A method which returns when a file was last verified, or when it was
+            last changed if it never has been.'''
+        # Get the record of the file
+        record = self.downloader.manifest.files.get(path.realpath(filename)) or dict()
+
+        # And return the time that the file was last verified
+        return record.get('verified') or lstat(filename).st_mtime
+
+
+    def copies(self, key, names):
+        ''' A method which returns the copies of a file which have been placed in
+            the build system, and the trees and copies made from it.'''
+        # Check that the file has a checksum
+        if key is None:
+            return list()
+
+        # Get the checksum of the file
+        algorithm, digest = key
+
+        # Find each of the files recorded with the same checksum
+        copies = [filename for filename, record in list(self.downloader.manifest.files.items())
+                    if record.get(algorithm) == digest and path.basename(filename) not in names
+                        and not filename.startswith(path.realpath(self.downloader.store))]
+
+        # Find the trees extracted from the file
+        for directory in {path.dirname(filename) for filename in copies} | \
+                {path.join(self.downloader.packages.environment['WANDER'], 'sources')}:
+            copies.append(path.join(directory, '.extracted', digest))
+            copies.append(path.join(directory, '.transcoded', digest + '.tar.zst'))
+
+        # And return the copies which still exist
+        return [filename for filename in copies if path.lexists(filename)]
+
+
+    def remove(self, filename):
+        ''' A method which removes a file or tree, and returns the number of
+            bytes reclaimed by doing so.'''
+        # Check if this is a tree
+        if path.isdir(filename) and not path.islink(filename):
+
+            # Work out the space taken by the files in the tree
+            size = sum(details.st_size for details in
+                        (lstat(path.join(directory, name)) for directory, _, names in walk(filename)
+                            for name in names) if details.st_nlink == 1)
+
+            # And remove it
+            rmtree(filename, ignore_errors = True)
+            return size
+
+        # Get the details of the file
+        details = lstat(filename)
+
+        # Remove the file and its record
+        deletefile(filename)
+        self.downloader.manifest.forget(filename)
+
+        # And only count the space if this was the last link to the file
+        return details.st_size if details.st_nlink == 1 else 0
@@ -1,11 +1,17 @@
+from bundle import Bundle
+from cgroup import Cgroups
+from jobserver import Jobserver
+from monitor import Monitor
 from stages.build import BuildSystem
 from stages.downloads import Downloader
+from stages.integrity import Integrity
 from stages.partitions import Partitions
 from stages.preparations import Preparations
 from stages.prerequisites import Prerequisites
+from tuner import Tuner
 from util import Output, Commands
 
-from os import path
+from os import cpu_count, path
 from yaml import safe_load as load, YAMLError
 
 class Main:
@@ -24,6 +30,22 @@ class Main:
         self.partitions    = Partitions()
         self.downloader    = Downloader(PATH)
 
+        # Create the pool of jobs which every make in the build shares
+        settings = self.downloader.metadata.get('build') or dict()
+
+        self.commands.jobserver = Jobserver(settings.get('jobs') or cpu_count() or 1)
+
+        # Create the cgroups which each module is built in, if they're used
+        if settings.get('isolate', False):
+            self.commands.cgroups = Cgroups()
+
+        # Load what's known about the number of jobs that each module builds best with
+        self.tuner = Tuner(path.join(self.downloader.store, '.tuning.yaml'),
+                           self.commands.jobserver.jobs, settings.get('tune', False))
+
+        # Create the monitor which holds each stage back when the host is strained
+        self.monitor = Monitor(settings.get('pressure', 20), settings.get('headroom', 1073741824))
+
         # Create the preparations and build systems
         self.preparations  = list()
         self.build         = list()
@@ -31,6 +53,30 @@ class Main:
         # Populate the stages environments
         self.create_stages(PATH)
 
+        # Create the checks of what each stage uses, which run just before the
+        # stage so that downloads in the background can carry on until then
+        self.integrity     = list()
+
+        # Store whether we've reached the stages built inside the chroot
+        chroot = False
+
+        # Iterate through each of the stages
+        for stage in range(len(self.build)):
+
+            # Check if the stage is the first to enter the chroot
+            if not chroot and 'chroot' in (self.preparations[stage].user, self.build[stage].user):
+
+                # The archives can't be reached from inside, so check this stage
+                # and all of those after it before entering
+                self.integrity.append(Integrity(self.downloader, self.build[stage:]))
+                chroot = True
+
+            else:
+
+                # Otherwise check the stage on its own, unless it's already checked
+                self.integrity.append(Integrity(self.downloader, [self.build[stage]])
+                                        if not chroot else None)
+
 
     def create_stages(self, PATH):
         ''' The system to create all of the preparation and build stages for
@@ -64,7 +110,8 @@ class Main:
 
                         # And append the items to the lists
                         self.preparations.append(Preparations(self.commands, PATH, (description, folder), self.partitions))
-                        self.build.append(BuildSystem(self.commands, PATH, self.downloader, (description, folder)))
+                        self.build.append(BuildSystem(self.commands, PATH, self.downloader, (description, folder),
+                                                      self.tuner, self.monitor))
 
             # If the syntax is improper, indicate as such
             except YAMLError as error:
@@ -85,13 +132,25 @@ class Main:
         # Collect each of our new stages
         for stage in range(len(self.preparations)):
 
-            # And add them to the list
-            modules.append(self.preparations[stage])
-            modules.append(self.build[stage])
+            # Get the check of what the stage uses, which has to come before the
+            # preparations if they enter the chroot, and otherwise before the build
+            checks = [self.integrity[stage]] if self.integrity[stage] is not None else list()
+
+            if self.preparations[stage].user == 'chroot':
+                modules.extend(checks + [self.preparations[stage], self.build[stage]])
+
+            else:
+                modules.extend([self.preparations[stage]] + checks + [self.build[stage]])
 
         # Iterate through each of the modules, and ensure that they succeed
         for error, module in enumerate(modules):
 
+            # Check if this module runs inside the chroot
+            if getattr(module, 'user', None) == 'chroot':
+
+                # The downloads can't reach the host from there, so let them finish
+                self.downloader.wait()
+
             # Check the prerequisites
             if not module.verify():
 
@@ -109,18 +168,82 @@ class Main:
         self.end(Main.ERROR_NONE)
 
 
+    def bundle(self, action, filename):
+        ''' The bundle method. This either writes all of the sources used by the
+            system into a single bundle file, or reads them back out of one.'''
+        # Send a friendly message to the user
+        Output.header('Welcome to Wander!\n')
+
+        # Create the bundle
+        bundle = Bundle(filename)
+
+        # Check if we're writing the bundle
+        if action == 'export':
+
+            # Make sure that we have all of the sources
+            result = self.downloader.verify()
+
+            # Check that the downloads started
+            if result:
+
+                # Wait for any which are downloading in the background
+                self.downloader.wait()
+
+                # And write them, which shows the user any that are missing
+                result = bundle.export(self.downloader)
+
+        else:
+
+            # Otherwise read the sources out of the bundle
+            result = bundle.unpack(self.downloader)
+
+        # Add some nice spacing
+        print()
+
+        # And exit with the result
+        self.end(0 if result else 1)
+
+
     def end(self, status):
         ''' The end method. This terminates the build of the wander system.'''
         # Close the application
         exit(status)
 
 
+from argparse import ArgumentParser
 from glob import glob
+from collector import Collector
+from mirror import Mirror
+from signal import default_int_handler, signal, SIGTERM
 from yaml import safe_load as load, YAMLError
 
 if __name__ == '__main__':
     ''' The entry point into the wander-py application. This starts the whole
         process, so that things can run smoothly.'''
+    # Create the parser for the command line
+    parser   = ArgumentParser(prog = 'wander', description = 'The Wander Linux builder.')
+    commands = parser.add_subparsers(dest = 'command')
+
+    # Add the command which builds the system, which is the default
+    commands.add_parser('build', help = 'build the wander system')
+
+    # Add the command which moves sources to and from a bundle
+    bundle = commands.add_parser('bundle', help = 'export or import an offline bundle of sources')
+    bundle.add_argument('action', choices = ['export', 'import'])
+    bundle.add_argument('file', help = 'the bundle to write or read')
+
+    # Add the command which serves the sources to other builders
+    mirror = commands.add_parser('mirror', help = 'serve the sources to other builders over http')
+    mirror.add_argument('--address', default = '0.0.0.0', help = 'the address to listen on')
+    mirror.add_argument('--port', type = int, default = 8000, help = 'the port to listen on')
+
+    # Add the command which removes unused sources
+    gc = commands.add_parser('gc', help = 'remove sources which no distribution uses')
+    gc.add_argument('--cap', type = int, help = 'the size, in bytes, to keep the store within')
+
+    # Read the command line
+    arguments = parser.parse_args()
+
     # Create a list of all of the distributions
     dists = list()
 
@@ -140,8 +263,47 @@ if __name__ == '__main__':
         # And close the application
         exit(-1)
 
+    # Check if we're serving the sources, which is done for every distribution
+    if arguments.command == 'mirror':
+
+        # Send a friendly message to the user
+        Output.header('Welcome to Wander!\n')
+
+        # Create the mirror
+        mirror = Mirror([Downloader(dist) for dist in dists], arguments.address, arguments.port)
+
+        # Stop in the same way when the service is stopped as when the user stops it
+        signal(SIGTERM, default_int_handler)
+
+        # And serve the sources until the user stops us
+        exit(0 if mirror.verify() else 1)
+
+    # Check if we're collecting unused sources, which is done for every store
+    elif arguments.command == 'gc':
+
+        # Send a friendly message to the user
+        Output.header('Welcome to Wander!\n')
+
+        # Store the downloader of each distribution, once for each store
+        stores = dict()
+
+        # Iterate through each of the distributions
+        for dist in dists:
+
+            # Get the distribution's downloader, and the store that it uses
+            downloader = Downloader(dist)
+            stores.setdefault(path.realpath(downloader.store), downloader)
+
+        # Collect each of the stores, down to the cap given or their own
+        result = all([Collector(downloader, arguments.cap if arguments.cap is not None
+                                    else downloader.cap or 0).verify()
+                        for downloader in stores.values()])
+
+        # And exit with the result
+        exit(0 if result else 1)
+
     # If there is only one item, bypass the check entirely
-    elif len(dists) == 1:
+    if len(dists) == 1:
 
         # Set the PATH variable
         PATH = dists[0]
@@ -183,4 +345,11 @@ if __name__ == '__main__':
 
     # Create the build environment
     main = Main(PATH)
-    main.begin()
+
+    # Check if we're working with a bundle
+    if arguments.command == 'bundle':
+        main.bundle(arguments.action, arguments.file)
+
+    # Otherwise build the system
+    else:
+        main.begin()
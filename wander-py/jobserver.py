@@ -0,0 +1,103 @@
+from os import close, O_NONBLOCK, O_RDONLY, open as openfd, pipe, read, write
+from select import select
+
+
+class Jobserver:
+    ''' The jobserver class. This holds a pool of tokens shared with every make
+        run during the build, in the same way that GNU make shares jobs with
+        the makes that it starts, so that the whole build stays within one
+        number of jobs however many modules, and makes, are running. Each make
+        has one job of its own, and takes a token for each job after that.'''
+
+
+    def __init__(self, jobs):
+        ''' The constructor. This creates the pipe which holds the tokens, and
+            fills it with a token for each job after the first.'''
+        # Store the number of jobs which may run at once
+        self.jobs = max(jobs, 1)
+
+        # Create the pipe which holds the tokens
+        self.input, self.output = pipe()
+
+        # Fill it with the tokens
+        write(self.output, b'+' * (self.jobs - 1))
+
+        try:
+            # Open the pipe again without blocking, so that we never wait for a
+            # token while a make is waiting on the same pipe
+            self.reader = openfd('/proc/self/fd/{}'.format(self.input), O_RDONLY | O_NONBLOCK)
+
+        # This is thrown if the pipe can't be opened again, such as without /proc
+        except OSError:
+            self.reader = None
+
+        # Store the tokens which we hold
+        self.tokens = list()
+
+
+    def flags(self):
+        ''' A method which returns the flags which tell make to use the pool.'''
+        return '-j{} --jobserver-auth={},{}'.format(self.jobs, self.input, self.output)
+
+
+    def acquire(self):
+        ''' A method which takes a token from the pool, if there is one, and
+            returns whether it was taken, without waiting for one.'''
+        try:
+            # Check if the pipe can be read without blocking
+            if self.reader is None and not select([self.input], [], [], 0)[0]:
+                return False
+
+            # Take a token from the pool
+            token = read(self.reader if self.reader is not None else self.input, 1)
+
+        # This is thrown if there are no tokens left
+        except BlockingIOError:
+            return False
+
+        # And hold on to it
+        self.tokens.append(token)
+        return True
+
+
+    def release(self):
+        ''' A method which returns a token to the pool.'''
+        # Check that we hold a token
+        if self.tokens:
+
+            # And give it back
+            write(self.output, self.tokens.pop())
+
+
+    def close(self):
+        ''' A method which closes the pool, once nothing else will use it.'''
+        # Close each end of the pipe
+        for descriptor in (self.input, self.output, self.reader):
+            if descriptor is not None:
+                close(descriptor)
+
+
+    def lease(self, jobs):
+        ''' A method which takes up to a number of jobs from the pool, without
+            waiting for them, and returns a pool of its own holding them, so
+            that a module can be built with fewer jobs than the whole pool.'''
+        # Store the number of tokens taken, as the first job is the module's own
+        taken = 0
+
+        # Take as many of the tokens as we can
+        while taken < jobs - 1 and self.acquire():
+            taken += 1
+
+        # And return a pool with the jobs which were taken
+        return Jobserver(taken + 1)
+
+
+    def reclaim(self, lease):
+        ''' A method which returns the jobs which were leased from the pool,
+            once the module using them has finished.'''
+        # Give back each of the tokens
+        for _ in range(lease.jobs - 1):
+            self.release()
+
+        # And close the leased pool
+        lease.close()
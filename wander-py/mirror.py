@@ -0,0 +1,212 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import fstat, path, remove
+from re import match
+from threading import Lock
+from urllib.parse import unquote
+from util import Output
+
+
+class Mirror:
+    ''' The mirror class. This serves the sources kept in the store to other
+        builders over HTTP, so that a fleet of builders only has to fetch each
+        file from upstream once. Files which aren't in the store yet are
+        downloaded from upstream when they're first asked for, and every file
+        is checked against the checksums of the distributions before it is
+        served.'''
+
+
+    def __init__(self, downloaders, address, port):
+        ''' The constructor. This creates a new mirror for the packages and
+            patches of a number of distributions, listening on an address.'''
+        # Create the server
+        self.server  = ThreadingHTTPServer((address, port), MirrorHandler)
+        self.server.mirror = self
+
+        # Store each of the files which can be served, by their checksums
+        self.files   = dict()
+
+        # Store the locks which stop a file being fetched twice at once
+        self.locks   = dict()
+        self.lock    = Lock()
+
+        # Iterate through each of the distributions
+        for downloader in downloaders:
+
+            # The mirror is the primary source, so it mustn't ask itself
+            downloader.primary = None
+
+            # And add each of its packages and patches
+            for downloads in (downloader.packages, downloader.patches):
+                for download in downloads.downloads.values():
+                    self.files[(download.algorithm, download.digest)] = download
+
+
+    def verify(self):
+        ''' A method which serves the sources until the mirror is stopped.'''
+        # Tell the user what's happening
+        Output.header('Serving {} sources on http://{}:{}/...'.format(len(self.files),
+                        *self.server.server_address[:2]))
+
+        try:
+            # Serve the sources
+            self.server.serve_forever()
+
+        # This is thrown when the user stops the mirror
+        except KeyboardInterrupt:
+            pass
+
+        # Stop the server
+        self.server.server_close()
+
+        # Remember what we verified for next time
+        for downloader in {download.parent.parent for download in self.files.values()}:
+            downloader.finish()
+
+        # And return that everything went well
+        return True
+
+
+    def stop(self):
+        ''' A method which stops the mirror from another thread, such as when
+            the mirror is run alongside something else.'''
+        self.server.shutdown()
+
+
+    def fetch(self, algorithm, digest):
+        ''' A method which makes sure that a file is in the store and matches
+            its checksum, downloading it from upstream if it isn't, and returns
+            the download or None if the file couldn't be found.'''
+        # Get the file with the checksum
+        download = self.files.get((algorithm, digest))
+
+        # Check that the file is one that we know about
+        if download is None:
+            return None
+
+        # Make sure that only one thread fetches each file
+        with self.lock:
+            lock = self.locks.setdefault((algorithm, digest), Lock())
+
+        with lock:
+
+            # Check the store, and download the file from upstream if needed
+            success = download.scan() and download.download() and download.checksum()
+
+            # If the copy in the store is damaged, fetch it again
+            if not success and path.isfile(download.source):
+                remove(download.source)
+                success = download.download() and download.checksum()
+
+        # Check that the file was found
+        if not success:
+            return None
+
+        # And return the file
+        return download
+
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    ''' The mirror handler class, which answers a single request made to the
+        mirror. Files are requested as /<algorithm>/<digest>/<name>, and ranges
+        are supported so that downloads can be resumed and split.'''
+
+
+    # Keep connections open between requests
+    protocol_version = 'HTTP/1.1'
+
+
+    def do_HEAD(self):
+        ''' A method which answers a HEAD request.'''
+        self.serve(False)
+
+
+    def do_GET(self):
+        ''' A method which answers a GET request.'''
+        self.serve(True)
+
+
+    def serve(self, body):
+        ''' A method which sends the file that was requested, or the part of it
+            that was asked for.'''
+        # Get the checksum of the file that was requested
+        request = match(r'^/([a-z0-9]+)/([0-9a-f]+)(/[^?]*)?$', unquote(self.path))
+
+        # Check that the request makes sense
+        if request is None:
+            return self.fail(404)
+
+        # Make sure that we have the file
+        download = self.server.mirror.fetch(request.group(1), request.group(2))
+
+        # Check that we found the file
+        if download is None:
+            return self.fail(404 if (request.group(1), request.group(2))
+                                    not in self.server.mirror.files else 502)
+
+        # Open the file to send it
+        with open(download.source, 'rb') as file:
+
+            # Get the size of the file
+            size = fstat(file.fileno()).st_size
+
+            # Work out which part of the file was asked for
+            start, end = 0, size - 1
+            extent = match(r'^bytes=(\d*)-(\d*)$', self.headers.get('Range') or '')
+
+            # Check if a range was asked for
+            if extent is not None and (extent.group(1) or extent.group(2)):
+
+                # Check if the range is from the end of the file
+                if not extent.group(1):
+                    start = max(size - int(extent.group(2)), 0)
+
+                else:
+                    start = int(extent.group(1))
+                    end   = min(int(extent.group(2)), end) if extent.group(2) else end
+
+                # Check that the range is possible
+                if start >= size or start > end:
+
+                    # And tell the client if it isn't
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */{}'.format(size))
+                    self.send_header('Content-Length', '0')
+                    return self.end_headers()
+
+                # Send the part of the file
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+
+            else:
+
+                # Send the whole file
+                self.send_response(200)
+
+            # Send the rest of the headers
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+
+            # Check that the file itself should be sent
+            if body:
+
+                # Make sure the headers have gone out
+                self.wfile.flush()
+
+                # And send the file straight from the disk
+                self.connection.sendfile(file, start, end - start + 1)
+
+
+    def fail(self, code):
+        ''' A method which tells the client that a request failed.'''
+        # Send the error
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+    def log_message(self, format, *arguments):
+        ''' A method which logs each request to the output.'''
+        Output.text('{} {}'.format(self.address_string(), format % arguments))
@@ -0,0 +1,228 @@
+from os import close, O_RDONLY, open as openfd, path, pread
+from time import monotonic as clock
+
+
+class Monitor:
+    ''' The monitor class. This watches how much memory is free, within the
+        host and within any cgroup that the build is limited by, and how much
+        the host is stalling for memory and disk, so that the build can hold
+        back new work and take jobs away from make before the host starts to
+        swap or kill processes. The files which are watched are opened before
+        the build enters the chroot, so that they can still be read inside it.'''
+
+
+    # The number of seconds between changes to the number of jobs, so that
+    # the pressure, which is averaged over ten seconds, can catch up
+    INTERVAL = 5
+
+
+    # The limits, and what's being used, of a cgroup in each version of cgroups
+    CGROUPS = {'2': ('memory.max', 'memory.current'),
+               '1': ('memory.limit_in_bytes', 'memory.usage_in_bytes')}
+
+
+    def __init__(self, threshold, headroom):
+        ''' The constructor. This opens each of the files which are watched.'''
+        # Store the pressure, as a percentage of time stalled, above which the
+        # build is held back, and the memory, in bytes, to keep free
+        self.threshold = threshold
+        self.headroom  = headroom
+
+        # Open the files which give the memory that's free, and the pressure
+        self.meminfo   = self.open('/proc/meminfo')
+        self.pressures = [descriptor for descriptor in (self.open('/proc/pressure/memory'),
+                                                        self.open('/proc/pressure/io'))
+                            if descriptor is not None]
+
+        # Open the files which give the limits of each of the build's cgroups
+        self.cgroups   = self.limits()
+
+        # Store the number of jobs that have been taken away from make
+        self.withheld  = 0
+        self.adjusted  = 0
+
+
+    def open(self, filename):
+        ''' A method which opens a file to be read again and again, returning
+            None if it can't be opened.'''
+        try:
+            # Open the file
+            return openfd(filename, O_RDONLY)
+
+        # This is thrown if the file doesn't exist, such as on older kernels
+        except OSError:
+            return None
+
+
+    def read(self, descriptor):
+        ''' A method which reads the latest contents of a file which was opened
+            earlier, returning None if it can't be read.'''
+        try:
+            # Read the file from its start
+            return pread(descriptor, 65536, 0).decode('utf-8', 'replace')
+
+        # This is thrown if the file can no longer be read
+        except OSError:
+            return None
+
+
+    def limits(self):
+        ''' A method which opens the memory limits, and what's being used, of
+            the cgroup which the build is in, and of each cgroup above it.'''
+        # Store the files opened for each cgroup
+        cgroups = list()
+
+        try:
+            # Read the cgroups that we're in
+            with open('/proc/self/cgroup', 'r') as stream:
+                lines = stream.read().split('\n')
+
+        # This is thrown if there are no cgroups
+        except OSError:
+            return cgroups
+
+        # Iterate through each of the cgroups that we're in
+        for line in lines:
+
+            # Get the hierarchy, and the controllers and location of the cgroup
+            parts = line.split(':', 2)
+
+            # Check that this is a cgroup which limits memory
+            if len(parts) != 3 or (parts[0] != '0' and 'memory' not in parts[1].split(',')):
+                continue
+
+            # Work out where the hierarchy is mounted, and which files to read
+            version = '2' if parts[0] == '0' else '1'
+            root    = '/sys/fs/cgroup/memory' if version == '1' else '/sys/fs/cgroup' \
+                        if path.isfile('/sys/fs/cgroup/cgroup.controllers') else '/sys/fs/cgroup/unified'
+
+            # Store the location of the cgroup
+            location = parts[2].strip('/')
+
+            # Iterate through the cgroup and each cgroup above it
+            while True:
+
+                # Open the limit and the usage of the cgroup
+                limit, usage = [self.open(path.join(root, location, name))
+                                    for name in Monitor.CGROUPS[version]]
+
+                # And keep them, if there is a limit
+                if limit is not None and usage is not None:
+                    cgroups.append((limit, usage))
+
+                # Otherwise close whichever was opened
+                else:
+                    for descriptor in (limit, usage):
+                        if descriptor is not None:
+                            close(descriptor)
+
+                # Check if we've reached the top
+                if not location:
+                    break
+
+                # And move to the cgroup above
+                location = path.dirname(location)
+
+        # And return the cgroups
+        return cgroups
+
+
+    def available(self):
+        ''' A method which returns the number of bytes of memory which are free
+            for the build, or None if this can't be told.'''
+        # Store the memory which is free
+        available = None
+
+        # Get the memory that the host says is available
+        meminfo = self.read(self.meminfo) if self.meminfo is not None else None
+
+        # Iterate through each of the lines of the memory information
+        for line in (meminfo or '').split('\n'):
+
+            # And store the memory available, which is in kilobytes
+            if line.startswith('MemAvailable:'):
+                available = int(line.split()[1]) * 1024
+
+        # Iterate through each of the cgroups which limit the build
+        for limit, usage in self.cgroups:
+
+            # Get the limit, and the memory used
+            limit, usage = self.read(limit), self.read(usage)
+
+            # Check that the cgroup is limited
+            if not limit or not usage or not limit.strip().isdigit():
+                continue
+
+            # And keep the least memory left
+            left      = max(int(limit) - int(usage), 0)
+            available = left if available is None else min(available, left)
+
+        # And return the memory which is free
+        return available
+
+
+    def pressure(self):
+        ''' A method which returns the greatest share of time, as a percentage,
+            that the host has recently stalled waiting for memory or disk.'''
+        # Store the greatest pressure
+        pressure = 0.0
+
+        # Iterate through each of the kinds of pressure
+        for descriptor in self.pressures:
+
+            # Iterate through each of the lines of the pressure
+            for line in (self.read(descriptor) or '').split('\n'):
+
+                # Get the pressure on some of the tasks over the last ten seconds
+                if line.startswith('some '):
+                    pressure = max(pressure, float(line.split()[1].split('=')[1]))
+
+        # And return the pressure
+        return pressure
+
+
+    def strained(self, memory = 0):
+        ''' A method which checks if the host is stalling, or if taking on some
+            memory would leave less free than it should.'''
+        # Get the memory which is free
+        available = self.available()
+
+        # And check if there's too much pressure, or too little memory
+        return self.pressure() >= self.threshold or \
+                (available is not None and available - memory < self.headroom)
+
+
+    def admit(self, memory = None):
+        ''' A method which checks if a module, which needs some memory, can be
+            started alongside those which are running.'''
+        return not self.strained(memory or 0)
+
+
+    def regulate(self, jobserver):
+        ''' A method which takes a job away from make when the host is strained,
+            and gives one back when it recovers, a step at a time.'''
+        # Check that there's a pool of jobs, and that it's time for a change
+        if jobserver is None or clock() - self.adjusted < Monitor.INTERVAL:
+            return
+
+        # Check if the host is strained
+        if self.strained():
+
+            # And take a job away, if one is free
+            if jobserver.acquire():
+                self.withheld += 1
+                self.adjusted  = clock()
+
+        # Otherwise give back a job, if any were taken
+        elif self.withheld:
+            jobserver.release()
+            self.withheld -= 1
+            self.adjusted  = clock()
+
+
+    def restore(self, jobserver):
+        ''' A method which gives back every job that was taken away from make.'''
+        # Give back each of the jobs
+        while self.withheld:
+            jobserver.release()
+            self.withheld -= 1
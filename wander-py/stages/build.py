@@ -1,16 +1,25 @@
-from os import path
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import path, statvfs
+from traceback import format_exception
 
 from exception import CommandException
 from util import Logger, Output, YAMLObject, set_chroot
+from yaml import safe_dump as dump
 
 
 class BuildSystem(YAMLObject):
     ''' The class responsible for building a portion of the system by iterating
         through each of the modules, compiling, configuring, and installing
-        it.'''
+        it. Modules which don't depend on each other are built at the same
+        time, and while they're built, the ones after them are extracted and
+        patched in the background, as far ahead as the free space allows.'''
 
 
-    def __init__(self, commands, location, downloader, stage):
+    # The number of times larger than its archive that a module is once extracted
+    EXPANSION = 10
+
+
+    def __init__(self, commands, location, downloader, stage, tuner = None, monitor = None):
         ''' The constructor. This creates the new system for building a set of
             modules used in wander.'''
         # Create the parent object
@@ -20,12 +29,30 @@ class BuildSystem(YAMLObject):
         self.commands = commands
 
         # Store the patches and packages for use later
-        self.packages = downloader.packages
-        self.patches  = downloader.patches
+        self.downloader = downloader
+        self.packages   = downloader.packages
+        self.patches    = downloader.patches
 
         # Store the stage that we are in
         self.stage = stage
 
+        # Store what's known about the number of jobs each module builds best with
+        self.tuner = tuner
+
+        # Store how many modules are built at once, how far ahead modules are
+        # prepared, and the space to leave free
+        settings = downloader.metadata.get('build') or dict()
+
+        self.workers   = max(settings.get('workers', 1), 1)
+        self.lookahead = settings.get('lookahead', 1)
+        self.reserve   = settings.get('reserve', 4294967296)
+
+        # Store the limits that each module is built within, if cgroups are used
+        self.limits    = settings.get('limits') or dict()
+
+        # Store the monitor which holds the build back when the host is strained
+        self.monitor   = monitor
+
         # Load the elements list
         self.load(path.join(location, self.stage[1], 'build.yaml'))
 
@@ -48,14 +75,28 @@ class BuildSystem(YAMLObject):
         # Get ready to run the stage
         result &= self.initialise()
 
-        # Iterate through each of the prerequisites, and verify them
-        for element in self.elements:
+        # Create each of the modules, so that they can be prepared ahead of time
+        modules = [Module(self.elements[element], self, element) for element in self.elements]
+
+        # Check that each of the modules depends on modules which exist
+        if self.depends(modules):
+
+            # And build them
+            result &= self.schedule(modules)
+
+        else:
+
+            # Otherwise nothing can be built
+            result = False
 
-            # Verify that the prerequisite is met
-            result &= Module(self.elements[element], self).verify()
+        # Remember how long each module took for next time
+        if self.tuner is not None:
+            self.tuner.save()
 
-            # Add the final line of output
-            print('')
+        # Remove anything which was prepared but never used
+        for module in modules:
+            if path.isdir(module.staging):
+                rmtree(module.staging)
 
         # Cleanup the stage
         result &= self.clean()
@@ -67,6 +108,351 @@ class BuildSystem(YAMLObject):
         return result
 
 
+    def depends(self, modules):
+        ''' A method which works out the modules that each module has to wait
+            for. Modules which don't list what they depend on wait for the one
+            before them, so that stages are built in order unless told not to.'''
+        # Get the names of each of the modules
+        names = [module.name for module in modules]
+
+        # Iterate through each of the modules
+        for index, module in enumerate(modules):
+
+            # Check if the module lists what it depends on
+            if module.depends is None:
+
+                # If not, it depends on the module before it
+                module.depends = set(names[max(index - 1, 0):index])
+
+            else:
+
+                # Otherwise use what it lists, which may be a single module
+                module.depends = {module.depends} if isinstance(module.depends, str) \
+                                    else set(module.depends)
+
+            # Check that each of the modules that it depends on exists
+            for name in module.depends - set(names):
+
+                # And tell the user if one doesn't
+                Output.text('{} depends on {}, which is not in this stage.'.format(module.name, name))
+                return False
+
+        # And return that everything went well
+        return True
+
+
+    def schedule(self, modules):
+        ''' A method which builds each of the modules as soon as the modules
+            that it depends on have been built, running up to the number of
+            workers at once. Modules which share a folder are never built at
+            the same time, and no new modules are started once one has failed.'''
+        # Store the modules which haven't started, and those which are running
+        pending = list(modules)
+        running = dict()
+
+        # Store the names of the modules which were built
+        built   = set()
+
+        # Store the result of the build, and what's being shown to the user
+        result  = True
+        shown   = None
+
+        # Show the output of each module as it's built, if only one runs at a time
+        verbose = self.workers == 1
+
+        # Get the pool of jobs shared with make, which each extra module takes from
+        jobserver = self.commands.jobserver
+
+        # Create the pools which build the modules, and prepare the upcoming ones
+        with ThreadPoolExecutor(max_workers = self.workers) as workers, \
+                ThreadPoolExecutor(max_workers = max(self.lookahead, 1)) as pool:
+
+            while True:
+
+                # Get the folders which are in use
+                busy = self.busy(pending, running.values())
+
+                # Iterate through each of the modules which haven't started, in order
+                for module in list(pending):
+
+                    # Check that there's room for another module, and nothing has failed
+                    if not result or len(running) >= self.workers:
+                        break
+
+                    # Check that the module's dependencies have been built, and
+                    # that its folder is free
+                    if not module.depends <= built or module.target in busy:
+                        continue
+
+                    # Check that the host can take the module on, if others are running
+                    if running and self.monitor is not None and not self.monitor.admit(module.memory):
+                        break
+
+                    # Check that there's a job for the module, if others are running
+                    if running and jobserver is not None:
+
+                        # Take one from the pool, or wait until there is one
+                        if not jobserver.acquire():
+                            break
+
+                        # And note that the module holds it
+                        module.token = True
+
+                    # Start building the module
+                    pending.remove(module)
+                    running[workers.submit(self.build, module, verbose)] = module
+
+                    # And note that its folder is in use
+                    busy.add(module.target)
+
+                # Start preparing the modules which come next
+                self.prefetch(pool, pending, running.values())
+
+                # Take jobs away from make if the host is strained, or give them back
+                if self.monitor is not None:
+                    self.monitor.regulate(jobserver)
+
+                # Get the preparations which are still running
+                staging = [module.staged for module in pending
+                            if module.staged is not None and not module.staged.done()]
+
+                # Check if there's nothing left to wait for
+                if not running and not staging:
+
+                    # Check if any modules couldn't be started
+                    if pending and result:
+
+                        # Tell the user which, as they must depend on each other
+                        Output.text('{} depend on each other.'.format(
+                                        ', '.join(module.name for module in pending)))
+                        result = False
+
+                    # And stop
+                    break
+
+                # Wait for a module to finish
+                finished, _ = wait(list(running) + staging, timeout = 0.25,
+                                   return_when = FIRST_COMPLETED)
+
+                # Iterate through each of the modules which finished
+                for future in [future for future in finished if future in running]:
+
+                    # Get the module, and whether it was built
+                    module  = running.pop(future)
+
+                    try:
+                        # Get whether it was built
+                        success = future.result()
+
+                    # This is thrown if something went wrong around the module
+                    except Exception as error:
+
+                        # So note why it failed
+                        module.error = error
+                        success      = False
+
+                    # Give back the job that the module held
+                    if module.token:
+                        jobserver.release()
+
+                    # Check if the module was stopped by an error
+                    if module.error is not None:
+
+                        # Mark it as failed
+                        module.report(Output.FAILED)
+
+                        # And keep the details of the error in its logs
+                        module.logger.log('error', module.name,
+                                          (''.join(format_exception(type(module.error), module.error,
+                                                                    module.error.__traceback__))
+                                                .encode('utf-8'), None))
+
+                    # Note that it was, or that the build has failed
+                    if success:
+                        built.add(module.name)
+
+                    result &= success
+
+                    # Tell the user how it went, if they haven't seen it already
+                    if not verbose:
+                        Output.clear()
+                        Output.log(module.status, module.description)
+
+                    # Add the final line of output
+                    print('')
+                    shown = None
+
+                    # Along with the error, if there was one
+                    if module.error is not None:
+                        Output.text('    {}: {}'.format(type(module.error).__name__, module.error))
+
+                    # And any limits which weren't applied
+                    for warning in module.warnings:
+                        Output.text('    Warning: ' + warning)
+
+                # Check if the user is shown the modules as they run
+                if verbose:
+                    continue
+
+                # Get the modules which are running
+                current = ', '.join(module.description for module in running.values())
+
+                # And show them, if they've changed
+                if current and current != shown:
+                    Output.clear()
+                    Output.log(Output.BUILDING, current)
+                    shown = current
+
+        # Give back any jobs which were taken away from make
+        if jobserver is not None and self.monitor is not None:
+            self.monitor.restore(jobserver)
+
+        # And return the result
+        return result
+
+
+    def build(self, module, verbose):
+        ''' A method which builds a module with the number of jobs which suits
+            it best, if that's known, and records how long it took. If cgroups
+            are used, the module is built in a cgroup of its own, and what it
+            used is written to its report.'''
+        # Get the pool of jobs shared with make
+        jobserver = self.commands.jobserver
+
+        # Get the number of jobs which the module should be built with
+        key   = '{}/{}'.format(self.stage[1], module.name)
+        level = self.tuner.level(key) if self.tuner is not None and not module.skip else None
+
+        # Keep to the most jobs that the module is known to cope with
+        if module.jobs is not None:
+            level = min(level or module.jobs, module.jobs)
+
+        # Take the jobs from the pool, if there's a number to use
+        lease = jobserver.lease(level) if level is not None and jobserver is not None else None
+
+        # Get the limits of the module, which may change those of the stage
+        limits = dict(self.limits)
+        limits.update(module.limits or dict())
+
+        # Create the cgroup of the module, if cgroups are used
+        cgroup = self.commands.cgroups.create('{}-{}'.format(self.stage[1], module.name), limits) \
+                    if self.commands.cgroups is not None and not module.skip else None
+
+        # Note the limits which couldn't be applied, so the user can be told
+        if self.commands.cgroups is not None and not module.skip and limits:
+            module.warnings = ['{} couldn\'t be applied.'.format(limit) for limit in
+                                (limits if cgroup is None else cgroup.skipped)]
+
+        # Give the jobs and the cgroup to the module's commands
+        self.commands.local.jobserver = lease
+        self.commands.local.cgroup    = cgroup
+
+        # Start measuring the memory that the module uses
+        self.commands.measure()
+
+        try:
+            # Build the module
+            result = module.verify(verbose)
+
+        # This is thrown if something went wrong that the module didn't expect
+        except Exception as error:
+
+            # So note why the module failed
+            module.error = error
+            result       = False
+
+        finally:
+
+            # And take back the jobs and the cgroup
+            self.commands.local.jobserver = None
+            self.commands.local.cgroup    = None
+
+            if lease is not None:
+                jobserver.reclaim(lease)
+
+        # Record how the module did, if it was built with a number of jobs
+        if result and lease is not None and self.tuner is not None:
+            self.tuner.record(key, lease.jobs, module.elapsed, self.commands.measure())
+
+        # Check if the module was built in a cgroup
+        if cgroup is not None:
+
+            # Write what the module used to its report
+            module.logger.log('report', 'cgroup ' + cgroup.name,
+                              (dump({'time': round(module.elapsed, 2), 'limits': cgroup.limits,
+                                     'skipped': cgroup.skipped, 'usage': cgroup.usage()},
+                                    default_flow_style = False)
+                                    .encode('utf-8'), None))
+
+            # And remove the cgroup
+            cgroup.remove()
+
+        # And return the result
+        return result
+
+
+    def busy(self, pending, running):
+        ''' A method which returns the folders which are in use, by modules
+            being built or prepared.'''
+        return {module.target for module in running} | \
+               {module.target for module in pending if module.staged is not None
+                    and not module.staged.done()}
+
+
+    def prefetch(self, pool, pending, running):
+        ''' A method which starts extracting and patching the modules which
+            haven't started yet in the background, in the order that they're
+            listed. This stops at the first module which can't be prepared yet.
+            Nothing is prepared ahead inside the chroot, as the programs which
+            extract and patch the modules there may be being reinstalled.'''
+        # Check that the modules are prepared with the host's programs
+        if self.user == 'chroot':
+            return
+
+        # Get the folders which are in use
+        busy = self.busy(pending, running)
+
+        # Get the space which is left for preparing modules
+        space = statvfs(path.dirname(pending[0].target)) if pending else None
+
+        # Check that there's something to prepare
+        if space is None:
+            return
+
+        space = space.f_bavail * space.f_frsize - self.reserve
+
+        # Take away the space which the modules being prepared will need
+        for module in pending:
+            if module.staged is not None and not module.staged.done():
+                space -= module.size() * BuildSystem.EXPANSION
+
+        # Iterate through each of the modules within reach
+        for module in pending[:self.lookahead]:
+
+            # Skip the modules which are already being prepared, or aren't built
+            if module.staged is not None or module.skip:
+                continue
+
+            # Check that the module doesn't share a folder with one in use
+            if module.target in busy:
+                break
+
+            # Check that the module's downloads have finished
+            if not self.downloader.ready(*module.downloads):
+                break
+
+            # Check that there's space to extract the module
+            if module.size() * BuildSystem.EXPANSION > space:
+                break
+
+            # And start preparing it
+            module.staged = pool.submit(module.stage)
+
+            # Noting the space and folder that it uses
+            space -= module.size() * BuildSystem.EXPANSION
+            busy.add(module.target)
+
+
     def initialise(self):
         ''' A method which initialises the system before the current stage has
             begun.'''
@@ -146,9 +532,10 @@ class BuildSystem(YAMLObject):
 
 
 import gzip
-from os import listdir, mkdir
-from shutil import move, rmtree
-import tarfile
+from os import geteuid, lchown, listdir, lstat, makedirs, mkdir, rename, rmdir, walk
+from archive import Archive
+from shutil import rmtree
+from time import monotonic as clock
 
 
 class Module:
@@ -156,10 +543,11 @@ class Module:
         module.'''
 
 
-    def __init__(self, element, parent):
+    def __init__(self, element, parent, name = None):
         ''' The init method, used to create a new module object which can be
             built on the host system.'''
         # Store information about the prerequisite
+        self.name     = name
         self.package  = element.get('package')
         self.patch    = element.get('patch')
         self.modules  = element.get('modules')
@@ -167,10 +555,18 @@ class Module:
         self.commands = element.get('commands')
         self.skip     = element.get('skip')
         self.result   = element.get('result')
+        self.depends  = element.get('depends')
+        self.memory   = element.get('memory')
+        self.jobs     = element.get('jobs')
+        self.limits   = element.get('limits')
 
         # Store the system for running commands
         self.parent   = parent
 
+        # Store the names of the packages and patches which the module needs
+        self.downloads = ([self.package] + (self.modules or list()),
+                          [self.patch] if self.patch is not None else list())
+
         # Extract information on the package archive itself
         self.package = parent.packages.elements[self.package]
 
@@ -212,19 +608,43 @@ class Module:
             # And make it an empty list
             self.modules = list()
 
-        # Note that we've started the check
-        Output.log(Output.PENDING, self.description)
+        # Store where the module is prepared ahead of its turn, and how that went
+        self.staging = '{}.{}.staging'.format(self.target, name) if name is not None \
+                        else self.target + '.staging'
+        self.staged  = None
+        self.patched = False
 
+        # Store whether the module holds a job from the pool shared with make
+        self.token   = False
 
-    def verify(self):
+        # Store how long the module took to build, once its sources were ready
+        self.elapsed = 0
+
+        # Store what stopped the module, if something unexpected did
+        self.error   = None
+
+        # Store the limits of the module which couldn't be applied
+        self.warnings = list()
+
+        # Store what the module is doing, and whether that's shown to the user
+        self.status  = Output.PENDING
+        self.verbose = True
+
+
+    def verify(self, verbose = True):
         ''' The verify method, which checks that a module built correctly, and
-            prints that to the console.'''
+            prints that to the console, unless it's built alongside others.'''
+        # Store whether the user is shown what the module is doing
+        self.verbose = verbose
+
+        # Note that we've started the check
+        self.report(Output.PENDING)
+
         # Check if this module should be skipped
         if self.skip:
 
             # We're now finished with this prerequisite
-            Output.clear()
-            Output.log(Output.SKIPPED, self.description)
+            self.report(Output.SKIPPED)
 
             # And return our result
             return True
@@ -248,62 +668,158 @@ class Module:
         for element, stage in elements:
 
             # Notify the user of what we're doing
-            Output.clear()
-            Output.log(stage, self.description)
+            self.report(stage)
+
+            # Note when the phase started
+            start = clock()
 
             # Add the result to our results variable
             result &= element()
 
+            # Note how long the phase took, unless it was getting the sources ready
+            if stage not in (Output.EXTRACTING, Output.PATCHING):
+                self.elapsed += clock() - start
+
             # Check that everything is still fine
             if not result:
 
                 # And stop our system
-                Output.clear()
-                Output.log(Output.FAILED, self.description)
+                self.report(Output.FAILED)
 
                 # And return our result
                 return False
 
         # At this point, we're pretty much finished
-        Output.clear()
-        Output.log(Output.PASSED, self.description)
+        self.report(Output.PASSED)
 
         # And return our result
         return True
 
 
+    def report(self, status):
+        ''' A simple method which notes what the module is doing, and shows the
+            user if they're following it.'''
+        # Store what the module is doing
+        self.status = status
+
+        # And show the user, if they're following the module
+        if self.verbose:
+            Output.clear()
+            Output.log(status, self.description)
+
+
     def extract(self):
         ''' A simple method which extracts the downloaded tarball so that it can
             be used.'''
-        # Open the archive
-        with tarfile.open(self.target + self.extension) as archive:
+        # Check if the module's downloads are still running in the background
+        if not self.parent.downloader.ready(*self.downloads):
 
-            # Check that there are no left-over sources
-            if path.isdir(self.target):
+            # And tell the user that we're waiting for them
+            self.report(Output.DOWNLOADING)
+
+        # Wait for the module's downloads to finish
+        if not self.parent.downloader.wait(*self.downloads):
+
+            # And stop if any of them failed
+            return False
+
+        # Tell the user what we're doing
+        self.report(Output.EXTRACTING)
+
+        # Check if the module was prepared while the one before it was built
+        if self.staged is not None and self.staged.result():
 
-                # And clear any left-over sources
+            # Clear any left-over sources
+            if path.isdir(self.target):
                 rmtree(self.target)
 
-            # Create the directory for the extraction
-            mkdir(self.target)
+            # And hand the prepared sources over
+            rename(self.staging, self.target)
+            self.patched = True
+
+            return True
+
+        # Otherwise throw away anything left from preparing the module
+        if path.isdir(self.staging):
+            rmtree(self.staging)
+
+        # And extract the sources now
+        return self.expand(self.target)
 
-            # Extract the archive contents
-            archive.extractall(self.target)
 
-        # Now that the archive has been extracted, sanitise the file name
-        self.file = self.file.replace('-src', '')
+    def stage(self):
+        ''' A method which extracts and patches the module into a staging folder
+            beside its own, while the modules before it are built, so that it's
+            ready when its turn comes. Anything that goes wrong is left for the
+            module to find again when it runs.'''
+        try:
+            # Clear any left-over staging folder
+            if path.isdir(self.staging):
+                rmtree(self.staging)
+
+            # Extract and patch the sources
+            return self.expand(self.staging) and self.fix(self.staging)
 
-        # Iterate through each of the folders we've just extracted
-        for item in listdir(path.join(self.target, self.file)):
+        # This is thrown if the sources couldn't be prepared
+        except Exception:
+            return False
 
-            # Move the contents one directory up
-            move(path.join(self.target, self.file, item), self.target)
+
+    def expand(self, target):
+        ''' A method which extracts the module's archive and the archives of its
+            sub-modules into a folder.'''
+        # Get the archive's download
+        download = self.parent.packages.downloads[self.downloads[0][0]]
+
+        # Work out where the archive was extracted to while it downloaded
+        extracted = path.join(path.dirname(self.target), '.extracted', download.digest)
+
+        # Get the user who builds the sources, if we can give files away
+        user  = self.parent.commands.USERS.get('wander') if geteuid() == 0 else None
+        owner = (user.pw_uid, user.pw_gid) if user is not None else None
+
+        # Check that the user exists, if we need them
+        if geteuid() == 0 and owner is None:
+            return False
+
+        # Check that there are no left-over sources
+        if path.isdir(target):
+
+            # And clear any left-over sources
+            rmtree(target)
+
+        # Check if the archive was extracted while it downloaded, into one folder
+        if path.isdir(extracted) and len(listdir(extracted)) == 1:
+
+            # If so, use that folder rather than extracting the archive again
+            rename(path.join(extracted, listdir(extracted)[0]), target)
+            rmdir(extracted)
+
+            # And give the files to the user who builds them, unless they were
+            # already given to them as they were extracted
+            if owner is not None and (lstat(target).st_uid, lstat(target).st_gid) != owner:
+                for directory, folders, files in walk(target):
+                    for item in [directory] + [path.join(directory, item) for item in folders + files]:
+                        lchown(item, *owner)
+
+        else:
+
+            # Throw away any folder that was extracted, as it can't be used
+            if path.isdir(extracted):
+                rmtree(extracted)
+
+            # Create the directory for the extraction
+            mkdir(target)
+
+            # Extract the archive contents, without its top folder
+            if not self.unpack(self.target + self.extension, download.digest, target, owner):
+                return False
 
         # Check if the folder variable is set
-        if self.folder is not None and not path.isdir(path.join(self.target, self.folder)):
+        if self.folder is not None and not path.isdir(path.join(target, self.folder)):
 
             # Create the build directory
-            mkdir(path.join(self.target, self.folder))
+            mkdir(path.join(target, self.folder))
 
         elif self.folder is None:
 
@@ -325,44 +841,64 @@ class Module:
             file        = package.get('file').replace('{version}', version)
             extension   = package.get('extension')
             folder      = value
-            target      = path.join(self.parent.environment['WANDER'], 'sources', file)
-            location    = path.join(self.parent.environment['WANDER'], 'sources', self.file)
+            archive     = path.join(path.dirname(self.target), file)
+            location    = path.join(target, folder)
 
-            # Open the archive
-            with tarfile.open(target + extension) as archive:
-
-                # Extract the archive contents
-                archive.extractall(path = location)
+            # Create the directory for the extraction
+            makedirs(location, exist_ok = True)
 
-            # Move the contents one directory up
-            move(path.join(location, file), path.join(location, folder))
+            # Extract the archive contents straight into its folder
+            if not self.unpack(archive + extension, self.parent.packages.downloads[value].digest,
+                               location, owner):
+                return False
 
             # And update the results variable
-            result &= path.isdir(path.join(self.target, folder))
+            result &= path.isdir(path.join(target, folder))
 
+        # Give the folders which we created to the user who builds the sources
+        if owner is not None and result:
+            for directory in {target, path.join(target, self.folder)} | \
+                    {path.join(target, value) for value in self.modules}:
+                lchown(directory, *owner)
 
-        # Finally, ensure that the extracted files have the correct permissions
-        try:
+        # And return if the directory exists
+        return path.isdir(target) and result
 
-            # Run the commands
-            self.parent.run(['chown -v -R wander ' + self.target],
-                directory = path.join(self.target, self.folder),
-                logger = self.logger, phase = 'unpacking', root = True)
 
-        except CommandException:
+    def size(self):
+        ''' A method which returns the size of the module's archives.'''
+        # Get the downloads of each of the module's archives
+        downloads = [self.parent.packages.downloads[package] for package in self.downloads[0]]
 
-            # And return how we did
-            return False
+        # And add up the sizes of those which exist
+        return sum(path.getsize(download.target) for download in downloads
+                    if path.isfile(download.target))
 
-        # And return if the directory exists
-        return path.isdir(self.target) and result
 
+    def unpack(self, archive, digest, directory, owner):
+        ''' A method which extracts an archive into a directory, without its
+            top folder, and gives the files to their owner as they're written.
+            The copy of the archive recompressed with zstd is used if there is
+            one, as it's much faster to decompress.'''
+        # Get the copy of the archive recompressed with zstd
+        transcoded = Archive(path.join(path.dirname(archive), '.transcoded', digest + '.tar.zst'),
+                             logger = self.logger)
+
+        # Check if the copy can be used
+        if path.isfile(transcoded.filename) and transcoded.program() is not None:
 
-    def fix(self):
+            # And extract it instead of the original
+            return transcoded.extract(directory, 1, owner)
+
+        # Otherwise extract the original
+        return Archive(archive, logger = self.logger).extract(directory, 1, owner)
+
+
+    def fix(self, target = None):
         ''' A simple method which patches the extracted sources so that
             compilation completes successfully.'''
-        # Check that there is a preparation for this module
-        if self.patch is None:
+        # Check that there is a preparation for this module, which isn't done
+        if self.patch is None or self.patched:
 
             # If there's nothing to do, return
             return True
@@ -373,7 +909,7 @@ class Module:
 
             # Run the commands
             self.parent.run(['patch -Np1 -i ../' + self.patch_file + self.patch_extension],
-                    directory = self.target,
+                    directory = target if target is not None else self.target,
                     logger = self.logger,
                     phase = 'patch')
 
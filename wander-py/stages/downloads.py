@@ -1,7 +1,13 @@
-from os import path
+from atexit import register
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, wait
+from os import getpid, path
+from threading import BoundedSemaphore, Lock, Thread
 
 import sys
+from bundle import Bundle
+from collector import Collector
 from util import Output
+from yaml import safe_load as load, YAMLError
 
 
 class Downloader():
@@ -10,12 +16,155 @@ class Downloader():
         copies it onto the wander build system.'''
 
 
+    # The default number of downloads which may run at the same time
+    WORKERS     = 8
+
+    # The default number of connections which may be made to a single host
+    CONNECTIONS = 4
+
+    # The default number of attempts made at downloading a single file
+    RETRIES     = 5
+
+    # The default number of seconds to wait before the first retry
+    BACKOFF     = 1
+
+    # The default number of seconds to wait on a stalled connection
+    TIMEOUT     = 30
+
+    # The default speed, in bytes per second, below which a mirror is abandoned
+    STALL       = 1024
+
+    # The default number of seconds for which a mirror's ranking is trusted
+    LIFETIME    = 86400
+
+    # The default number of pieces that a large file is downloaded in
+    SEGMENTS    = 4
+
+    # The default size, in bytes, above which a file is downloaded in pieces
+    THRESHOLD   = 33554432
+
+
     def __init__(self, location):
         ''' The constructor. This creates the new system for downloading each of
             the packages.'''
+        # Store where the distribution is kept
+        self.location = location
+
+        # Load the download settings for this distribution
+        self.metadata = self.configure(path.join(location, '__metadata.yaml'))
+        self.settings = self.metadata.get('downloads') or dict()
+
+        # Store whether the downloads run in the background during the build
+        self.background  = self.settings.get('background', False)
+
+        # Store the limits on the number of concurrent downloads
+        self.workers     = self.settings.get('workers', Downloader.WORKERS)
+        self.connections = self.settings.get('connections', Downloader.CONNECTIONS)
+
+        # Store how hard we try to download each file
+        self.retries     = self.settings.get('retries', Downloader.RETRIES)
+        self.backoff     = self.settings.get('backoff', Downloader.BACKOFF)
+        self.timeout     = self.settings.get('timeout', Downloader.TIMEOUT)
+        self.stall       = self.settings.get('stall', Downloader.STALL)
+
+        # Store how large files are split up
+        self.segments    = self.settings.get('segments', Downloader.SEGMENTS)
+        self.threshold   = self.settings.get('threshold', Downloader.THRESHOLD)
+
+        # Store whether archives are extracted while they download
+        self.stream      = self.settings.get('stream', False)
+
+        # Store whether a copy of each archive is recompressed with zstd
+        self.transcode   = self.settings.get('transcode', False)
+
+        # Store the size, in bytes, that the store is kept within, if any
+        self.cap         = self.settings.get('cap')
+
+        # Store the mirrors for each of the upstream locations
+        self.mirrors     = self.settings.get('mirrors') or dict()
+
+        # Store the caching mirror which is always tried first, if there is one
+        self.primary     = self.settings.get('primary')
+
+        # Store the bundles which files can be read from instead of downloaded
+        self.bundles     = [Bundle(bundle) for bundle in self.settings.get('bundles') or list()
+                                if path.isfile(bundle)]
+
+        # Create the per-host connection limits
+        self.hosts = dict()
+        self.lock  = Lock()
+
+        # Note that the downloads haven't finished, and nothing was collected
+        self.finished  = False
+        self.removed   = 0
+        self.reclaimed = 0
+
+        # Create the connections which are shared between downloads
+        self.pool  = ConnectionPool(self.timeout)
+
+        # Store where the downloaded archives are kept, by their checksums
+        self.store    = self.settings.get('store', path.join(sys.path[0], '..', 'sources'))
+
+        # Load the record of files which have already been verified
+        self.manifest = Manifest(path.join(self.store, '.manifest.yaml'))
+
+        # Load the rankings of the mirrors
+        self.ranking  = Mirrors(path.join(self.store, '.mirrors.yaml'), self.pool,
+                                self.settings.get('lifetime', Downloader.LIFETIME))
+
         # Create the items for downloading packages and patches
-        self.packages = DownloadList(path.join(location, 'packages.yaml'))
-        self.patches  = DownloadList(path.join(location, 'patches.yaml'))
+        self.packages = DownloadList(path.join(location, 'packages.yaml'), self)
+        self.patches  = DownloadList(path.join(location, 'patches.yaml'), self)
+
+        # Check if archives are extracted while they download
+        if self.stream:
+
+            # Iterate through each of the modules which are built
+            for element in self.modules():
+
+                # And extract the module's own archive, but not those that it
+                # includes, as they're extracted into the module's folder later
+                if element.get('package') in self.packages.downloads:
+                    self.packages.downloads[element.get('package')].extract = True
+
+
+    def configure(self, filename):
+        ''' A method which loads a YAML file from the distribution, such as the
+            metadata file which holds the download settings.'''
+        # Store the contents that we find
+        contents = None
+
+        # Load the YAML file
+        with open(filename, 'r') as stream:
+
+            # Read from the stream
+            try:
+
+                # Store the file contents
+                contents = load(stream)
+
+            # If the syntax is improper, indicate as such
+            except YAMLError as error:
+                print(error)
+
+        # And return the contents, or an empty set if there are none
+        return contents if contents is not None else dict()
+
+
+    def connection(self, host):
+        ''' A method which returns the semaphore limiting the number of
+            connections which may be made to a single host.'''
+        # Make sure only one thread creates the semaphore
+        with self.lock:
+
+            # Check if this host has been seen before
+            if host not in self.hosts:
+
+                # And create a new limit for it
+                self.hosts[host] = BoundedSemaphore(self.connections)
+
+            # And return the limit
+            return self.hosts[host]
 
 
     def verify(self):
@@ -24,11 +173,49 @@ class Downloader():
         # Tell the user what's happening
         Output.header("Downloading required packages and patches...")
 
-        # Download all of the packages
-        result = self.packages.verify()
+        # Make sure the files aren't collected while the build uses them
+        self.pin()
+
+        # Check if the downloads should happen during the build instead
+        if self.background:
+
+            # Start the downloads in the order that they're needed
+            self.start()
+
+            # Inform the user of the status
+            Output.text('Packages and patches will be downloaded as the build runs.')
+            Output.footer(True, "Downloading required packages and patches")
+
+            # And return the result
+            return True
 
-        # And download all of the patches
-        result &= self.patches.verify()
+        # Create the pool which runs the downloads
+        with ThreadPoolExecutor(max_workers = self.workers) as pool:
+
+            # Start all of the packages and patches downloading
+            self.packages.submit(pool)
+            self.patches.submit(pool)
+
+            # Report on all of the packages
+            result = self.packages.verify()
+
+            # And report on all of the patches
+            result &= self.patches.verify()
+
+        # Finish up with the downloads
+        self.finish()
+
+        # Tell the user how each of the hosts performed
+        for host, statistics in sorted(self.pool.report().items()):
+
+            Output.text('{}: {} requests on {} connections, {:.0f} ms latency, {:.2f} MiB/s'.format(
+                    host, statistics['requests'], statistics['connections'],
+                    statistics['latency'] * 1000, statistics['throughput'] / 1048576))
+
+        # Tell the user if any unused files were collected
+        if self.removed:
+            Output.text('Removed {} unused files, reclaiming {:.2f} MiB.'.format(self.removed,
+                        self.reclaimed / 1048576))
 
         # Inform the user of the status
         Output.footer(result, "Downloading required packages and patches")
@@ -37,12 +224,173 @@ class Downloader():
         return result
 
 
+    def pin(self):
+        ''' A method which pins each of the files that the build uses, so that
+            they aren't collected by another process while the build runs. The
+            pin is removed when the build ends.'''
+        # Store where the pin is kept
+        filename = path.join(self.store, '.pins', '{}.yaml'.format(getpid()))
 
-from hashlib import md5
-from os import makedirs, remove as deletefile
-from shutil import copyfile
-from urllib.error import HTTPError
-from urllib.request import urlretrieve as get
+        # Make sure there's somewhere to put the pin
+        makedirs(path.dirname(filename), exist_ok = True)
+
+        # Write each of the files which the build uses
+        with open(filename, 'w') as stream:
+            dump(sorted([download.algorithm, download.digest] for downloads in
+                            (self.packages, self.patches) for download in downloads.downloads.values()),
+                 stream)
+
+        # And remove the pin when the build ends
+        register(self.unpin, filename)
+
+
+    def unpin(self, filename):
+        ''' A method which removes a pin once the build has ended.'''
+        try:
+            # Remove the pin
+            deletefile(filename)
+
+        # This is thrown if the pin has gone, or can't be seen from a chroot
+        except OSError:
+            pass
+
+
+    def start(self):
+        ''' A method which starts all of the downloads in the background, in the
+            order that the build will use them.'''
+        # Create the pool which runs the downloads
+        pool = ThreadPoolExecutor(max_workers = self.workers)
+
+        # Start each of the downloads in the order that they're needed
+        for downloads, name in self.order():
+            downloads.submit(pool, [name])
+
+        # Let the pool close itself once everything is finished
+        pool.shutdown(wait = False)
+
+        # And finish up once all of the downloads are done
+        Thread(target = self.wait, daemon = True).start()
+
+
+    def order(self):
+        ''' A method which returns each of the packages and patches, in the
+            order that the modules of each of the stages will use them, followed
+            by anything which isn't used.'''
+        # Store the order of the downloads
+        order = list()
+
+        # Iterate through each of the modules
+        for element in self.modules():
+
+            # Add the package and any packages that the module includes
+            order += [(self.packages, name) for name in
+                        [element.get('package')] + (element.get('modules') or list())]
+
+            # And add the patch, if there is one
+            if element.get('patch') is not None:
+                order.append((self.patches, element.get('patch')))
+
+        # Add everything else at the end
+        order += [(self.packages, name) for name in self.packages.downloads]
+        order += [(self.patches, name) for name in self.patches.downloads]
+
+        # And return the order, without any duplicates
+        return [item for index, item in enumerate(order)
+                    if item[1] in item[0].downloads and item not in order[:index]]
+
+
+    def modules(self):
+        ''' A method which returns the modules of each of the stages which are
+            built, in the order that they're built.'''
+        # Store the modules
+        modules = list()
+
+        # Get the stages of the build
+        stages = self.metadata.get('stages') or dict()
+
+        # Iterate through each of the stages
+        for stage in stages:
+
+            # Check that the stage is being built
+            if stages[stage].get('bypass'):
+                continue
+
+            # And add the modules in the stage
+            modules += (self.configure(path.join(self.location, stage, 'build.yaml'))
+                            .get('elements') or dict()).values()
+
+        # And return the modules
+        return modules
+
+
+    def ready(self, packages = (), patches = ()):
+        ''' A method which checks whether or not a set of packages and patches
+            have finished downloading.'''
+        # Check each of the downloads
+        return all(downloads.futures[name].done()
+                    for downloads, names in ((self.packages, packages), (self.patches, patches))
+                    for name in names if name in downloads.futures)
+
+
+    def wait(self, packages = None, patches = None):
+        ''' A method which waits for a set of packages and patches to finish
+            downloading, and returns whether or not they all worked. If none are
+            given, this waits for everything and then finishes up.'''
+        # Check if we're waiting for everything
+        everything = packages is None and patches is None
+
+        # Store the result of the downloads
+        result = True
+
+        # Wait for each of the downloads
+        for downloads, names in ((self.packages, packages), (self.patches, patches)):
+
+            # Wait for everything in the list if we're waiting for everything
+            names = downloads.futures.keys() if everything else names or list()
+
+            # Iterate through each of the downloads
+            for name in list(names):
+
+                # Get the download, if it has been started
+                future = downloads.futures.get(name)
+
+                # And wait for it to finish
+                result &= future is None or future.result()
+
+        # Check if everything is finished
+        if everything:
+
+            # And finish up, only once
+            with self.lock:
+                if not self.finished:
+                    self.finish()
+
+        # And return the result
+        return result
+
+
+    def finish(self):
+        ''' A method which tidies up after all of the downloads have finished,
+            keeping a record of what happened for the next run.'''
+        # Note that we've finished
+        self.finished = True
+
+        # Keep the store within its size cap, if it has one
+        if self.cap is not None:
+            self.removed, self.reclaimed = Collector(self, self.cap).collect()
+
+        # Remember what we verified for next time
+        self.manifest.save()
+
+        # Close any connections which are left open
+        self.pool.close()
+
+        # And remember how quickly each of the hosts responded
+        self.ranking.save(self.pool.report())
+
+
+
+from os import makedirs
 from util import YAMLObject
 
 class DownloadList(YAMLObject):
@@ -50,17 +398,20 @@ class DownloadList(YAMLObject):
         YAML object.'''
 
 
-    def __init__(self, object):
+    def __init__(self, object, parent):
         ''' The constructor. This loads a list of objects to download from the
             YAML file.'''
         # Create the parent object
         YAMLObject.__init__(self)
 
+        # Store the downloader which owns this list
+        self.parent = parent
+
         # Load the elements list
         self.load(object)
 
         # List some directories which need to exist
-        directories = [path.join(sys.path[0], '..', 'sources'),
+        directories = [self.parent.store,
                        path.join(self.environment['WANDER'], 'sources')]
 
         # Go through each of the directories and do the things
@@ -72,60 +423,68 @@ class DownloadList(YAMLObject):
                 # And create the directory if it does not
                 makedirs(directory)
 
+        # Create each of the downloads in the list
+        self.downloads = {element: Download(self.elements[element], self)
+                            for element in self.elements}
 
-    def verify(self):
-        ''' The method which iterates through each item in the list and performs
-            the appropriate actions.'''
-        # Collect each of the elements which needs to be built
-        elements = [(self.scan,      Output.SCANNING),
-                    (self.download,  Output.DOWNLOADING),
-                    (self.checksum,  Output.VERIFYING),
-                    (self.copy,      Output.COPYING)]
+        # Create a placeholder for the running downloads
+        self.futures = dict()
+
+
+    def submit(self, pool, names = None):
+        ''' The method which starts items in the list downloading on a pool of
+            workers, either those named or everything in the list.'''
+        # Submit each of the downloads in turn
+        for name in names if names is not None else self.downloads:
+            self.futures[name] = pool.submit(self.downloads[name].verify)
 
+
+    def verify(self):
+        ''' The method which waits for each item in the list to finish, and
+            reports the results in the order of the file.'''
         # Store all of the results
         result = True
 
         # Iterate through each item in turn
-        for element in self.elements:
+        for name, future in self.futures.items():
 
-            # Get the information from the file
-            self.version     = self.elements[element].get('version')
-            self.description = self.elements[element].get('description') + ' ' + str(self.version)
-            self.file        = self.elements[element].get('file').replace('{version}', str(self.version))
-            self.extension   = self.elements[element].get('extension')
-            self.url         = path.join(self.elements[element].get('url').replace('{version}', str(self.version)).replace('{version_}', str(self.version).replace('.', '_')), self.file + self.extension)
-            self.md5         = self.elements[element].get('md5')
+            # Get the item being downloaded
+            download = self.downloads[name]
 
-            # Store the root file name
-            self.source      = path.join(sys.path[0], '..', 'sources', self.file)
-            self.target      = path.join(self.environment['WANDER'], 'sources', self.file)
+            # Store the last status we showed to the user
+            status = None
+
+            # Wait for the download to finish
+            while True:
 
-            # Notify the user of what's happening
-            Output.log(Output.PENDING, self.description)
+                # Check if the download has changed what it's doing
+                if download.status != status:
 
-            # Presume that each stage will run successfully
-            success = True
+                    # And notify the user of what's happening
+                    status = download.status
+                    Output.clear()
+                    Output.log(status, download.description)
 
-            # Iterate through each of the phases
-            for element, stage in elements:
+                try:
+                    # Get the result of the download
+                    success = future.result(timeout = 0.25)
 
-                # Notify the user of what we're doing
-                Output.clear()
-                Output.log(stage, self.description)
+                    # And stop waiting
+                    break
 
-                # Add the result to our success variable
-                success &= element()
+                # This is thrown if the download is still running
+                except TimeoutError:
+                    pass
 
-                # Add the result to our results variable
-                result &= success
+            # Add the result to our results variable
+            result &= success
 
-                # And stop if there is an error
-                if not success:
-                    break
+            # Note how the file was placed in the build system, if it was
+            method = ' ({})'.format(download.method) if download.method else ''
 
             # At this point, we're pretty much finished
             Output.clear()
-            Output.log(Output.PASSED if success else Output.FAILED, self.description)
+            Output.log(Output.PASSED if success else Output.FAILED, download.description + method)
 
             # Add the final line of output
             print('')
@@ -134,91 +493,1588 @@ class DownloadList(YAMLObject):
         return result
 
 
-    def scan(self):
-        ''' A simple method which checks if the archive exists in the target
-            directory but not the sources directory, and if so, copies it over
-            so that we have a copy.'''
-        # Check that only the target copy of the file exists
-        if not path.isfile(self.source + self.extension) and path.isfile(self.target + self.extension):
 
-            # Check that the target version of the file matches our checksum
-            if self.checksum(self.target):
+from os import replace as rename, stat
+from time import time
+from yaml import safe_dump as dump
 
-                # Copy the file over
-                copyfile(self.target + self.extension, self.source + self.extension)
+class Manifest:
+    ''' The manifest class, which keeps a record of the checksum of each file
+        that has been verified, so that files which have not changed since do
+        not have to be hashed again.'''
 
-                # And return if the file exists
-                return path.isfile(self.source + self.extension)
 
-            # Otherwise we have a bad checksum, so delete the file
-            else:
+    def __init__(self, filename):
+        ''' The constructor. This loads the record of verified files from the
+            disk, if there is one.'''
+        # Store where the manifest is kept
+        self.filename = filename
 
-                # Delete the bad file
-                deletefile(self.target + self.extension)
+        # Create the record of verified files
+        self.files = dict()
+        self.lock  = Lock()
 
-                # And return if the file does not exist
-                return not path.isfile(self.target + self.extension)
+        # Check that there is a manifest to load
+        if path.isfile(self.filename):
 
+            # Load the YAML file
+            with open(self.filename, 'r') as stream:
 
-        # Either a source file exists or a target one does not, so return
-        return True
+                # Read from the stream
+                try:
 
+                    # Store the file contents
+                    self.files = load(stream) or dict()
 
+                # If the manifest is damaged, we'll simply verify everything
+                except YAMLError:
+                    pass
 
-    def download(self):
-        ''' A simple method which checks if the archive exists in the local
-            sources directory, and if not, downloads it from the specified
-            address.'''
-        # Check that the file doesn't exist
-        if not path.isfile(self.source + self.extension):
+
+    def signature(self, filename):
+        ''' A method which returns the details of a file which change whenever
+            the contents of the file are changed.'''
+        # Get the information about the file
+        details = stat(filename)
+
+        # And return the parts that we care about
+        return [details.st_size, details.st_mtime_ns, details.st_ino]
+
+
+    def lookup(self, filename, algorithm):
+        ''' A method which returns the recorded checksum of a file, or None if
+            the file has changed since it was recorded.'''
+        # Get the record of the file
+        with self.lock:
+            record = self.files.get(path.realpath(filename))
+
+        # Check that the file still exists and is unchanged
+        if record is None or not path.isfile(filename) \
+                or record.get('signature') != self.signature(filename):
+            return None
+
+        # Note when the file was last found to be good
+        with self.lock:
+            record['verified'] = int(time())
+
+        # And return the checksum
+        return record.get(algorithm)
+
+
+    def record(self, filename, algorithm, digest):
+        ''' A method which records the checksum of a file which has just been
+            verified.'''
+        # Get the details of the file
+        signature = self.signature(filename)
+
+        # Make sure only one thread changes the records at a time
+        with self.lock:
+
+            # Get the existing record of the file
+            record = self.files.get(path.realpath(filename))
+
+            # Check that the record is for this version of the file
+            if record is None or record.get('signature') != signature:
+
+                # And start a new record if it isn't
+                record = {'signature': signature}
+
+            # And store the checksum, and when it was verified
+            record[algorithm]   = digest
+            record['verified']  = int(time())
+            self.files[path.realpath(filename)] = record
+
+
+    def forget(self, filename):
+        ''' A method which removes the record of a file, if there is one.'''
+        # Remove the file from the records
+        with self.lock:
+            self.files.pop(path.realpath(filename), None)
+
+
+    def save(self):
+        ''' A method which writes the record of verified files to the disk.'''
+        # Make sure only one thread writes the manifest at a time
+        with self.lock:
+
+            # Only keep the records of files which still exist
+            files = {key: value for key, value in self.files.items()
+                        if path.isfile(key)}
+
+            # Write to a temporary file, so that the manifest is never half written
+            with open(self.filename + '.part', 'w') as stream:
+                dump(files, stream)
+
+            # And move it into place
+            rename(self.filename + '.part', self.filename)
+
+
+
+from http.client import HTTPConnection, HTTPException, HTTPSConnection
+from time import monotonic as clock
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlparse, urlsplit
+from urllib.request import Request, urlopen
+
+class ConnectionPool:
+    ''' The connection pool, a small HTTP/1.1 client which keeps connections
+        to each host open between requests so that they can be reused, and
+        which keeps track of how quickly each host responds.'''
+
+
+    # The number of redirects which will be followed for a single request
+    REDIRECTS = 8
+
+
+    def __init__(self, timeout):
+        ''' The constructor. This creates an empty pool of connections.'''
+        # Store how long to wait on a stalled connection
+        self.timeout = timeout
+
+        # Create the idle connections to each host
+        self.idle = dict()
+        self.lock = Lock()
+
+        # Create the statistics for each host
+        self.statistics = dict()
+
+
+    def open(self, url, headers = None):
+        ''' A method which makes a request for a url, following any redirects,
+            and returns the response. Errors are raised as an HTTPError.'''
+        # Make sure there are some headers to send
+        headers = dict(headers or dict(), **{'User-Agent': 'wander',
+                                             'Accept-Encoding': 'identity'})
+
+        # Follow the redirects until we find the file
+        for redirect in range(ConnectionPool.REDIRECTS + 1):
+
+            # Split the url into its parts
+            parts = urlsplit(url)
+
+            # Check that this is a url that we can request ourselves
+            if parts.scheme not in ('http', 'https'):
+
+                # And let urllib handle it if not
+                return urlopen(Request(url, headers = headers), timeout = self.timeout)
+
+            # Make the request
+            key      = (parts.scheme, parts.netloc)
+            response = self.request(key, parts, headers)
+
+            # Check if we're being sent somewhere else
+            if response.status in (301, 302, 303, 307, 308) \
+                    and response.headers.get('Location') is not None:
+
+                # Work out where we're being sent
+                url = urljoin(url, response.headers.get('Location'))
+
+                # And finish with this response, so the connection can be reused
+                response.read()
+                response.close()
+                continue
+
+            # Check if the request failed
+            if response.status >= 400:
+
+                # Finish with the response
+                response.read()
+                response.close()
+
+                # And raise the error
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, None)
+
+            # And return the response
+            return response
+
+        # At this point, we've been redirected too many times
+        raise HTTPError(url, 310, 'Too many redirects', None, None)
+
+
+    def request(self, key, parts, headers):
+        ''' A method which sends a request on a pooled connection to a host,
+            and returns the response.'''
+        # Store the path being requested
+        location = parts.path + ('?' + parts.query if parts.query else '')
+
+        # Make two attempts, as an idle connection may have been closed
+        for attempt in range(2):
+
+            # Get a connection to the host
+            connection, reused = self.acquire(key)
+
+            # Note when the request was made
+            start = clock()
 
             try:
-                # Download the file
-                get(self.url, self.source + self.extension)
+                # Send the request
+                connection.request('GET', location, headers = headers)
 
-            # This is thrown if something goes wrong with the download
-            except HTTPError:
-                pass
+                # And wait for the response
+                response = connection.getresponse()
 
-        # And return if the file exists
-        return path.isfile(self.source + self.extension)
+            # This is thrown if the connection has gone away
+            except (HTTPException, OSError):
 
+                # So close the connection
+                connection.close()
 
-    def checksum(self, source = None):
-        ''' A simple method which checks if the downloaded file has the correct
-            checksum and was not tampered with on the download.'''
-        # If source is not defined, use the local source
-        if not source:
-            source = self.source
+                # And try again on a new connection if it was an old one
+                if reused and attempt == 0:
+                    continue
 
-        # Open the file to verify it
-        with open(source + self.extension, 'rb') as file:
+                raise
 
-            # Generate the MD5 has
-            hash = md5()
+            # Record how long the host took to respond
+            self.measure(parts.netloc, latency = clock() - start, opened = not reused)
 
-            # Read the data in a loop
-            while True:
+            # And return the response
+            return PooledResponse(self, key, connection, response)
 
-                # Read in a chunk of data
-                data = file.read(8192)
 
-                # Check that that chunk is not empty
-                if not data:
-                    break
+    def acquire(self, key):
+        ''' A method which returns an idle connection to a host, or a new one if
+            there are none, along with whether or not it was reused.'''
+        # Check if there is an idle connection
+        with self.lock:
 
-                # And update our hash
-                hash.update(data)
+            # And take it out of the pool if there is
+            if self.idle.get(key):
+                return self.idle[key].pop(), True
 
-        # And return if our file matches
-        return hash.hexdigest() == self.md5
+        # Otherwise, create the right type of connection
+        if key[0] == 'https':
+            return HTTPSConnection(key[1], timeout = self.timeout), False
 
+        return HTTPConnection(key[1], timeout = self.timeout), False
 
-    def copy(self):
-        ''' A simple method which copies our downloaded archive into the build
-            systems' sources directory.'''
-        # Copy the file over
-        copyfile(self.source + self.extension, self.target + self.extension)
 
-        # And return if the file exists
-        return path.isfile(self.target + self.extension)
+    def release(self, key, connection):
+        ''' A method which returns a connection to the pool once it has
+            finished with a request, so that it can be used again.'''
+        # Put the connection back in the pool
+        with self.lock:
+            self.idle.setdefault(key, list()).append(connection)
+
+
+    def measure(self, host, latency = None, opened = False, received = 0, elapsed = 0):
+        ''' A method which updates the statistics kept for a host.'''
+        # Make sure only one thread changes the statistics at a time
+        with self.lock:
+
+            # Get the statistics for the host
+            statistics = self.statistics.setdefault(host,
+                    {'requests': 0, 'connections': 0, 'latency': 0.0,
+                     'bytes': 0, 'seconds': 0.0})
+
+            # Check if a request was made
+            if latency is not None:
+
+                # And add it to the statistics
+                statistics['requests']    += 1
+                statistics['connections'] += 1 if opened else 0
+                statistics['latency']     += latency
+
+            # Add the data which was received
+            statistics['bytes']   += received
+            statistics['seconds'] += elapsed
+
+
+    def report(self):
+        ''' A method which returns the average latency, in seconds, and the
+            throughput, in bytes per second, of each host.'''
+        # Make sure the statistics don't change while we read them
+        with self.lock:
+
+            # And work out the averages for each host
+            return {host: {'requests':    value['requests'],
+                           'connections': value['connections'],
+                           'latency':     value['latency'] / max(value['requests'], 1),
+                           'throughput':  value['bytes'] / max(value['seconds'], 1e-9)}
+                        for host, value in self.statistics.items()}
+
+
+    def close(self):
+        ''' A method which closes all of the idle connections in the pool.'''
+        # Take all of the connections out of the pool
+        with self.lock:
+            idle, self.idle = self.idle, dict()
+
+        # And close each of them
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+
+
+class PooledResponse:
+    ''' The pooled response class, which wraps a response from a pooled
+        connection, and returns the connection to the pool once the response
+        has been read.'''
+
+
+    def __init__(self, pool, key, connection, response):
+        ''' The constructor. This wraps a response to a request.'''
+        # Store the pool and connection that the response came from
+        self.pool       = pool
+        self.key        = key
+        self.connection = connection
+        self.response   = response
+
+        # Store the details of the response
+        self.status     = response.status
+        self.reason     = response.reason
+        self.headers    = response.headers
+
+
+    def read(self, amount = None):
+        ''' A method which reads data from the response, and keeps track of how
+            quickly it arrived.'''
+        # Note when the read started
+        start = clock()
+
+        # Read the data
+        data = self.response.read(amount)
+
+        # And record it against the host
+        self.pool.measure(self.key[1], received = len(data), elapsed = clock() - start)
+
+        # And return the data
+        return data
+
+
+    def close(self):
+        ''' A method which finishes with the response, returning the connection
+            to the pool if it can be used again.'''
+        # Check that the connection is still usable
+        if self.connection is None:
+            return
+
+        # Check if the whole response was read, and the server will keep it open
+        if self.response.isclosed() and not self.response.will_close \
+                and not self.response.length:
+
+            # And put the connection back in the pool
+            self.pool.release(self.key, self.connection)
+
+        else:
+
+            # Otherwise the connection can't be used again
+            self.response.close()
+            self.connection.close()
+
+        # And note that we're finished with the connection
+        self.connection = None
+
+
+    def __enter__(self):
+        ''' A method which allows the response to be used in a with block.'''
+        return self
+
+
+    def __exit__(self, *arguments):
+        ''' A method which closes the response at the end of a with block.'''
+        self.close()
+
+
+
+class Mirrors:
+    ''' The mirrors class, which ranks the hosts that a file can be downloaded
+        from by how quickly they respond, and remembers the ranking between
+        runs.'''
+
+
+    # The number of bytes fetched from a host when measuring it
+    PROBE = 65536
+
+
+    def __init__(self, filename, pool, lifetime):
+        ''' The constructor. This loads the rankings measured in earlier runs,
+            if there are any.'''
+        # Store where the rankings are kept
+        self.filename = filename
+
+        # Store the connections used to measure each host
+        self.pool     = pool
+
+        # Store how long a measurement is trusted for, in seconds
+        self.lifetime = lifetime
+
+        # Create the record of each host
+        self.hosts    = dict()
+        self.lock     = Lock()
+
+        # Create the locks which stop a host being measured twice at once
+        self.probes   = dict()
+
+        # Check that there are rankings to load
+        if path.isfile(self.filename):
+
+            # Load the YAML file
+            with open(self.filename, 'r') as stream:
+
+                # Read from the stream
+                try:
+
+                    # Store the file contents
+                    self.hosts = load(stream) or dict()
+
+                # If the rankings are damaged, we'll simply measure again
+                except YAMLError:
+                    pass
+
+
+    def rank(self, urls):
+        ''' A method which returns a list of urls for the same file, ordered
+            from the fastest host to the slowest.'''
+        # Check that there is anything to rank
+        if len(urls) < 2:
+            return list(urls)
+
+        # Make sure that each of the hosts has been measured recently
+        for url in urls:
+            self.measure(url)
+
+        # And sort the urls by how long each host should take
+        return sorted(urls, key = lambda url: self.score(urlparse(url).netloc))
+
+
+    def measure(self, url):
+        ''' A method which measures the latency and throughput of the host of a
+            url by downloading the start of the file, unless the host has been
+            measured recently.'''
+        # Get the host of the url
+        host = urlparse(url).netloc
+
+        # Make sure that only one thread measures each host
+        with self.lock:
+            probe = self.probes.setdefault(host, Lock())
+
+        with probe:
+
+            # Check if the host has been measured recently
+            with self.lock:
+                record = self.hosts.get(host)
+
+            if record is not None and time() - record.get('time', 0) < self.lifetime:
+                return
+
+            # Note when the measurement started
+            start = clock()
+
+            try:
+                # Ask for the start of the file
+                with self.pool.open(url, {'Range': 'bytes=0-{}'.format(Mirrors.PROBE - 1)}) as response:
+
+                    # Note how long the host took to respond
+                    latency = clock() - start
+
+                    # And download the data, but no more than we asked for, in
+                    # case the host ignores the range and sends the whole file,
+                    # in which case the connection is dropped rather than drained
+                    size = len(response.read(Mirrors.PROBE))
+
+                # Store how the host performed
+                record = {'latency':    latency,
+                          'throughput': size / max(clock() - start - latency, 1e-6)}
+
+            # This is thrown if the host is not working
+            except (HTTPException, OSError):
+
+                # So remember that it failed
+                record = {'failed': True}
+
+            # And store the measurement
+            self.update(host, record)
+
+
+    def update(self, host, record):
+        ''' A method which stores a new measurement of a host.'''
+        # Note when the measurement was made
+        record['time'] = time()
+
+        # And store it
+        with self.lock:
+            self.hosts[host] = record
+
+
+    def score(self, host):
+        ''' A method which returns roughly how many seconds a host would take to
+            send a megabyte, with failed hosts coming last.'''
+        # Get the record of the host
+        with self.lock:
+            record = self.hosts.get(host, dict())
+
+        # Check that the host is working
+        if record.get('failed') or not record.get('throughput'):
+            return float('inf')
+
+        # And work out the score
+        return record['latency'] + 1048576 / record['throughput']
+
+
+    def save(self, statistics = None):
+        ''' A method which writes the rankings to the disk, updated with the
+            statistics gathered from any downloads which were made.'''
+        # Add the measurements from the downloads themselves
+        for host, value in (statistics or dict()).items():
+
+            # Check that enough data was downloaded to be useful
+            if value['requests'] > 0 and value['throughput'] > 0:
+
+                # And store it
+                self.update(host, {'latency':    value['latency'],
+                                   'throughput': value['throughput']})
+
+        # Make sure the rankings don't change while they're written
+        with self.lock:
+            hosts = dict(self.hosts)
+
+        # Write to a temporary file, so that the rankings are never half written
+        with open(self.filename + '.part', 'w') as stream:
+            dump(hosts, stream)
+
+        # And move it into place
+        rename(self.filename + '.part', self.filename)
+
+
+
+from errno import ETIMEDOUT
+from hashlib import new as hasher
+from http.client import HTTPException, IncompleteRead
+from os import devnull, posix_fallocate as fallocate, pread, pwrite, remove as deletefile
+from time import monotonic as clock, sleep
+from urllib.error import HTTPError
+from archive import Archive
+from os import geteuid
+from pwd import getpwnam
+from shutil import which
+from subprocess import DEVNULL, PIPE, Popen
+from urllib.parse import urlparse
+from util import clone
+
+class Download:
+    ''' The download class, which stores information about a single archive,
+        and downloads, verifies, and copies it.'''
+
+
+    # The checksums which can be used to verify a file, strongest first
+    ALGORITHMS = ('sha512', 'sha256', 'blake2b', 'md5')
+
+    # The number of bytes read from a file at a time when hashing it
+    BUFFER     = 1048576
+
+    def __init__(self, element, parent):
+        ''' The init method, used to create a new download object which can be
+            fetched onto the host system.'''
+        # Get the information from the file
+        self.version     = element.get('version')
+        self.description = element.get('description') + ' ' + str(self.version)
+        self.file        = element.get('file').replace('{version}', str(self.version))
+        self.extension   = element.get('extension')
+        self.url         = self.resolve(element.get('url'))
+
+        # Store the mirrors which have a copy of the file
+        self.urls        = [self.url] + [self.resolve(url) for url in element.get('mirrors') or list()]
+
+        # Add the mirrors of the upstream location
+        for upstream, mirrors in parent.parent.mirrors.items():
+
+            # Check that this file comes from that location
+            if self.url.startswith(upstream):
+
+                # And add each of its mirrors
+                self.urls += [mirror + self.url[len(upstream):] for mirror in mirrors]
+
+        # Use the strongest checksum that the file lists
+        self.algorithm   = next(algorithm for algorithm in Download.ALGORITHMS
+                                    if element.get(algorithm) is not None)
+        self.digest      = str(element.get(self.algorithm)).lower()
+
+        # Store where the archive is kept in the store, and where it is used
+        self.source      = path.join(parent.parent.store, self.algorithm, self.digest[:2], self.digest)
+        self.target      = path.join(parent.environment['WANDER'], 'sources', self.file + self.extension)
+
+        # Store where the archive was kept before there was a store
+        self.cache       = path.join(sys.path[0], '..', 'sources', self.file + self.extension)
+
+        # Store where the archive is extracted to while it downloads, and
+        # whether it is, which is only for the archives that modules are built from
+        self.extracted   = path.join(path.dirname(self.target), '.extracted', self.digest)
+        self.extractor   = None
+        self.extract     = False
+
+        # Store where the copy recompressed with zstd is kept, and where it's used
+        self.zstd        = self.source + '.tar.zst'
+        self.transcoded  = path.join(path.dirname(self.target), '.transcoded', self.digest + '.tar.zst')
+
+        # Store the list which owns this download
+        self.parent      = parent
+
+        # Note that we haven't started yet
+        self.status      = Output.PENDING
+
+        # Note that the file has not yet been verified or copied
+        self.verified    = False
+        self.copied      = False
+        self.method      = None
+
+
+    def owner(self):
+        ''' A method which returns the user and group that the archive's files
+            are given to when it's extracted while it downloads, which is the
+            user who builds the sources, or None if the files can't be given
+            away or the user doesn't exist yet.'''
+        # Check that we're allowed to give files away
+        if geteuid() != 0:
+            return None
+
+        try:
+            # Get the user who builds the sources
+            user = getpwnam('wander')
+
+        # This is thrown if the user hasn't been created yet
+        except KeyError:
+            return None
+
+        # And return their user and group
+        return user.pw_uid, user.pw_gid
+
+
+    def resolve(self, url):
+        ''' A method which returns the full url of the file, given the address
+            of the folder on a server.'''
+        # Fill in the version of the file
+        url = url.replace('{version}', str(self.version)).replace('{version_}', str(self.version).replace('.', '_'))
+
+        # And add the name of the file
+        return path.join(url, self.file + self.extension)
+
+
+    def verify(self):
+        ''' The method which runs through each of the phases of the download,
+            stopping if any of them fail.'''
+        # Collect each of the elements which needs to be run
+        elements = [(self.scan,      Output.SCANNING),
+                    (self.download,  Output.DOWNLOADING),
+                    (self.checksum,  Output.VERIFYING),
+                    (self.copy,      Output.COPYING),
+                    (self.transcode, Output.TRANSCODING)]
+
+        # Iterate through each of the phases
+        for element, stage in elements:
+
+            # Note what we're doing
+            self.status = stage
+
+            # And stop if there is an error
+            if not element():
+                return False
+
+        # And return that everything went well
+        return True
+
+
+    def scan(self):
+        ''' A simple method which checks if the archive is missing from the
+            store, but a copy of it already exists either in the build system
+            or in the old sources directory, and if so, moves it into the store
+            so that we have a copy.'''
+        # Check that the store doesn't already have the file
+        if path.isfile(self.source):
+            return True
+
+        # Check each of the places the file might already be
+        for filename in (self.cache, self.target):
+
+            # Check that the file is there
+            if not path.isfile(filename):
+                continue
+
+            # Check that the file matches our checksum
+            if self.checksum(filename):
+
+                # Make sure there's somewhere to put the file
+                makedirs(path.dirname(self.source), exist_ok = True)
+
+                # Move the old copy into the store, or clone the build system's
+                if filename == self.cache:
+                    rename(filename, self.source)
+
+                else:
+                    clone(filename, self.source)
+
+                # The file is now in the store, so there's no need to check it
+                self.verified = True
+                self.parent.parent.manifest.record(self.source, self.algorithm, self.digest)
+
+                # And stop looking
+                break
+
+            # Otherwise we have a bad checksum, so delete the file
+            deletefile(filename)
+            self.parent.parent.manifest.forget(filename)
+
+        # And return if the target file is good, if there is one
+        return not path.isfile(self.target) or path.isfile(self.source)
+
+
+    def download(self):
+        ''' A simple method which checks if the archive exists in the local
+            sources directory, and if not, downloads it from the fastest of its
+            mirrors, moving on to the next if one fails. The download is written
+            to a partial file, which is resumed if the transfer is interrupted,
+            and only renamed into place once its checksum matches.'''
+        # Check that the file doesn't exist
+        if path.isfile(self.source):
+
+            # If it does, there's nothing to do
+            return True
+
+        # Make sure there's somewhere to put the file
+        makedirs(path.dirname(self.source), exist_ok = True)
+
+        # Store the names of the partial files
+        partial = self.source + '.part'
+        staged  = self.target + '.part'
+
+        # Only write a second copy if the store can't be cloned cheaply later
+        if stat(path.dirname(self.source)).st_dev == stat(path.dirname(self.target)).st_dev:
+            staged = None
+
+        # Check if the file can be read from a bundle instead
+        if self.unbundle(partial):
+            return True
+
+        # Store the downloader's settings
+        downloader = self.parent.parent
+
+        # Rank the mirrors of the file, fastest first
+        urls = downloader.ranking.rank(self.urls)
+
+        # Try the caching mirror before any of the others
+        if downloader.primary:
+            urls.insert(0, '{}/{}/{}/{}'.format(downloader.primary.rstrip('/'), self.algorithm,
+                                                self.digest, self.file + self.extension))
+
+        # Make a number of attempts at the download
+        for attempt in range(downloader.retries):
+
+            # Check that there are mirrors left to try
+            if not urls:
+                break
+
+            # Wait a little longer after each failed attempt
+            if attempt > 0:
+                sleep(downloader.backoff * 2 ** (attempt - 1))
+
+            # Try each of the mirrors in turn
+            for url in list(urls):
+
+                # Try to download the file from the mirror
+                result = self.attempt(url, partial, staged, len(urls) > 1)
+
+                # Keep the tree extracted during the download only if it worked
+                if self.extractor is not None:
+                    self.extractor.promote(result is True)
+                    self.extractor = None
+
+                # Stop using the mirror if it won't ever work
+                if result is None:
+                    urls.remove(url)
+
+                # And stop if the download worked
+                elif result:
+                    return True
+
+        # And return if the file exists
+        return path.isfile(self.source)
+
+
+    def unbundle(self, partial):
+        ''' A method which copies the file out of one of the bundles given in
+            the settings, if any of them have it, as if they were just another
+            sources directory.'''
+        # Store the downloader's settings
+        downloader = self.parent.parent
+
+        # Iterate through each of the bundles
+        for bundle in downloader.bundles:
+
+            try:
+                # Look for the file in the bundle
+                data = bundle.find(self.algorithm, self.digest)
+
+            # This is thrown if the bundle is damaged
+            except (OSError, ValueError):
+                continue
+
+            # Check that the file is there, and intact
+            if data is None or hasher(self.algorithm, data).hexdigest() != self.digest:
+                continue
+
+            # Write the file out of the bundle
+            with open(partial, 'wb') as file:
+                file.write(data)
+
+            # And move the file into place
+            rename(partial, self.source)
+            downloader.manifest.record(self.source, self.algorithm, self.digest)
+
+            # There's now no need to read the file back again
+            self.verified = True
+
+            # And note that we're finished
+            return True
+
+        # At this point, none of the bundles have the file
+        return False
+
+
+    def attempt(self, url, partial, staged, abandon):
+        ''' A method which makes a single attempt at downloading a file from a
+            mirror. This returns True if the file was downloaded, False if it
+            wasn't, and None if the mirror is not worth trying again.'''
+        # Store the downloader's settings
+        downloader = self.parent.parent
+
+        try:
+            # Resume the download in pieces, if the file was being split
+            hash, teed = self.split(url, partial, staged) if path.isfile(partial + '.segments') \
+                            else (None, False)
+
+            # Otherwise download the file in one piece
+            if hash is None:
+
+                # Make sure we don't open too many connections to the host
+                with downloader.connection(urlparse(url).netloc):
+
+                    # Download the rest of the file
+                    hash, teed = self.fetch(url, partial, staged, abandon)
+
+                # And download it in pieces instead, if it's big enough
+                if hash is None:
+                    hash, teed = self.split(url, partial, staged)
+
+        # This is thrown if the server refuses to give us the file
+        except HTTPError as error:
+
+            # Stop using the mirror if the error won't go away
+            if error.code < 500 and error.code not in (408, 416, 429):
+                return None
+
+            # Check if the server is telling us that we have everything
+            if error.code != 416:
+                return False
+
+            try:
+                # If so, check what we have against our checksum
+                hash, teed = self.hash(partial), False
+
+            # This is thrown if what we have can't be read
+            except OSError:
+                return False
+
+        # This is thrown if the transfer is interrupted or stalls
+        except (HTTPException, OSError):
+
+            # So resume the download on the next attempt
+            return False
+
+        # Check that the finished file has the correct checksum
+        if hash.hexdigest() == self.digest:
+
+            # And move the file into place
+            rename(partial, self.source)
+            downloader.manifest.record(self.source, self.algorithm, self.digest)
+
+            # Check if the file was also written to the build system
+            if teed:
+
+                # And move that into place too
+                rename(staged, self.target)
+                downloader.manifest.record(self.target, self.algorithm, self.digest)
+                self.method = 'streamed'
+
+            # There's now no need to read the file back again
+            self.verified = True
+            self.copied   = teed
+
+            # And note that we're finished
+            return True
+
+        # Otherwise the partial files are bad, so start again from scratch
+        for file in (partial, staged, partial + '.segments'):
+
+            # Check that the file exists
+            if file is not None and path.isfile(file):
+
+                # And delete it
+                deletefile(file)
+
+        # And note that we need to try again
+        return False
+
+
+    def split(self, url, partial, staged):
+        ''' A method which downloads a large file in several pieces at once,
+            each over its own connection, into the file which was allocated for
+            it when the file was found to be large enough. The progress of each
+            piece is kept beside the partial file so that the download can be
+            resumed. As the start of the file fills in, it is hashed, written to
+            the build system, and extracted in order, just as in one piece. This
+            returns the hash of the file, or None if the progress was damaged
+            and the file should be downloaded again.'''
+        # Store where the progress of each piece is kept
+        progress = partial + '.segments'
+
+        # Load the YAML file
+        with open(progress, 'r') as stream:
+
+            # Read from the stream
+            try:
+
+                # Get the pieces of the file
+                segments = load(stream)
+
+            # If the progress is damaged, start again from scratch
+            except YAMLError:
+                segments = None
+
+        # Check that the progress matches the partial file
+        if not segments or not path.isfile(partial):
+
+            # And start again from scratch if it doesn't
+            for file in (partial, progress):
+
+                # Check that the file exists
+                if path.isfile(file):
+
+                    # And delete it
+                    deletefile(file)
+
+            return None, False
+
+        # Store whether all of the pieces worked
+        errors = list()
+
+        # Create the hash, and note that the build system gets a copy
+        hash, teed = hasher(self.algorithm), staged is not None
+
+        # Extract the archive as it arrives, if we're asked to
+        if self.extract and '.tar' in self.extension:
+            self.extractor = Extractor(self.extracted, self.owner())
+
+        # Open the file to write each of the pieces into it, and the copy
+        with open(partial, 'r+b') as file, \
+             open(staged if teed else devnull, 'wb') as copy:
+
+            # Create the threads which download each piece
+            with ThreadPoolExecutor(max_workers = len(segments)) as pool:
+
+                # Start each of the unfinished pieces downloading
+                futures = [pool.submit(self.segment, url, file.fileno(), segment)
+                                for segment in segments if segment[2] < segment[1]]
+
+                # Store how much of the start of the file has been handed on
+                handed = 0
+
+                # Hand on the start of the file as it fills in
+                while True:
+
+                    # Note whether the pieces have all finished
+                    finished = all(future.done() for future in futures)
+
+                    # Work out how far the file is filled in from its start
+                    filled = next((segment[2] for segment in segments
+                                    if segment[2] < segment[1]), segments[-1][1])
+
+                    # Read the data in a loop
+                    while handed < filled:
+
+                        # Read in a chunk of data
+                        data = pread(file.fileno(), min(Download.BUFFER, filled - handed), handed)
+
+                        # Check that that chunk is not empty
+                        if not data:
+                            break
+
+                        # Update our hash, and write it to the copy
+                        hash.update(data)
+                        copy.write(data)
+
+                        # And to the extraction, if there is one
+                        if self.extractor is not None:
+                            self.extractor.write(data)
+                        handed += len(data)
+
+                    # Stop once every piece has finished
+                    if finished:
+                        break
+
+                    # Otherwise wait a little for the pieces to get further
+                    wait(futures, timeout = 0.1)
+
+                # Check each of the pieces
+                for future in futures:
+
+                    try:
+                        # Get the result of the piece
+                        future.result()
+
+                    # This is thrown if the piece failed
+                    except (HTTPError, HTTPException, OSError) as error:
+                        errors.append(error)
+
+        # Check if any of the pieces failed
+        if errors:
+
+            # Remember how far each of the pieces got
+            with open(progress, 'w') as stream:
+                dump(segments, stream)
+
+            # And raise the first error
+            raise errors[0]
+
+        # Check if there was any progress to forget
+        if path.isfile(progress):
+
+            # And delete it
+            deletefile(progress)
+
+        # And return the hash of the whole file
+        return hash, teed
+
+
+    def plan(self, partial, size):
+        ''' A method which splits a file into the pieces that it's downloaded
+            in, allocating the whole file up front and noting the progress of
+            each piece, so that the download can be carried out, or resumed, by
+            the split method.'''
+        # Store the downloader's settings
+        downloader = self.parent.parent
+
+        # Work out the size of each piece
+        length = -(-size // downloader.segments)
+
+        # Split the file into pieces, each of which is [start, end, done]
+        segments = [[start, min(start + length, size), start]
+                        for start in range(0, size, length)]
+
+        # Allocate the whole file up front
+        with open(partial, 'wb') as file:
+
+            try:
+                # Ask the filesystem to reserve the space
+                fallocate(file.fileno(), 0, size)
+
+            # This is thrown if the filesystem can't reserve space
+            except OSError:
+
+                # So just set the size of the file
+                file.truncate(size)
+
+        # And note the progress of each of the pieces
+        with open(partial + '.segments', 'w') as stream:
+            dump(segments, stream)
+
+
+    def segment(self, url, descriptor, segment):
+        ''' A method which downloads one piece of a file, writing it into its
+            place in the file, and keeping track of how far it has got.'''
+        # Store the downloader's settings
+        downloader = self.parent.parent
+
+        # Get the part of the piece which is still needed
+        start, end, done = segment
+
+        # Make sure we don't open too many connections to the host
+        with downloader.connection(urlparse(url).netloc):
+
+            # Ask for the rest of the piece
+            with downloader.pool.open(url, {'Range': 'bytes={}-{}'.format(done, end - 1)}) as response:
+
+                # Check that the server sent the piece we asked for
+                if response.status != 206:
+                    raise HTTPException('The server did not send the range requested')
+
+                # Read the data in a loop
+                while segment[2] < end:
+
+                    # Read in a chunk of data
+                    data = response.read(min(65536, end - segment[2]))
+
+                    # Check that that chunk is not empty
+                    if not data:
+                        raise IncompleteRead(b'', end - segment[2])
+
+                    # Write it into its place in the file
+                    pwrite(descriptor, data, segment[2])
+
+                    # And note how far we've got
+                    segment[2] += len(data)
+
+
+    def fetch(self, url, partial, staged, abandon = False):
+        ''' A method which downloads a file into a partial file, continuing on
+            from the end of any partial file which already exists. The data is
+            hashed as it arrives, and also written to the build system's copy of
+            the file where possible, so that the archive never has to be read
+            back from the disk, and is extracted as it arrives if the settings
+            ask for it. If abandon is set, the download is stopped if it becomes
+            too slow, so that another mirror can be tried. If the response shows
+            that the file is big enough to download in pieces, the pieces are
+            planned instead, and None is returned in place of the hash.'''
+        # Store the downloader's settings
+        downloader = self.parent.parent
+
+        # Work out how much of the file we already have
+        offset = path.getsize(partial) if path.isfile(partial) else 0
+
+        # Only ask for the part of the file that we're missing
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else dict()
+
+        # Open the connection to the server
+        with downloader.pool.open(url, headers) as response:
+
+            # Check if the server honoured our range
+            if response.status == 206:
+
+                # Extract the archive as it arrives, if we're asked to, starting
+                # with the part of the file we already have
+                if self.extract and '.tar' in self.extension:
+                    self.extractor = Extractor(self.extracted, self.owner())
+
+                # And hash the part of the file we already have
+                hash = self.hash(partial, self.extractor)
+
+                # And only write to the build system if it has the same part
+                teed = staged is not None and path.isfile(staged) \
+                        and path.getsize(staged) == offset
+
+                # Append to the files
+                mode = 'ab'
+
+            else:
+
+                # Get the size of the file, if the server told us it
+                length = response.headers.get('Content-Length') or ''
+                size   = int(length) if length.isdigit() else 0
+
+                # Check if the file is big enough to download in pieces, and if
+                # the server will send it in pieces
+                if downloader.segments >= 2 and size >= downloader.threshold and \
+                        response.headers.get('Accept-Ranges', '').strip().lower() == 'bytes':
+
+                    # And plan the pieces, leaving the rest of this response unread
+                    self.plan(partial, size)
+                    return None, False
+
+                # Otherwise start everything again from scratch
+                hash, teed, mode = hasher(self.algorithm), staged is not None, 'wb'
+
+                # And extract the archive as it arrives, if we're asked to
+                if self.extract and '.tar' in self.extension:
+                    self.extractor = Extractor(self.extracted, self.owner())
+
+            # Store the speed below which we give up on the mirror
+            stall = downloader.stall if abandon else 0
+
+            # Start measuring the speed of the download
+            window, count = clock(), 0
+
+            # Store how much data we've received
+            received = 0
+
+            # Open the partial files to write to them
+            with open(partial, mode) as file, \
+                 open(staged if teed else devnull, mode) as copy:
+
+                # Read the data in a loop
+                while True:
+
+                    # Read in a chunk of data
+                    data = response.read(65536)
+
+                    # Check that that chunk is not empty
+                    if not data:
+                        break
+
+                    # Update our hash
+                    hash.update(data)
+
+                    # And write it to the files
+                    file.write(data)
+                    copy.write(data)
+
+                    # And to the extraction, if there is one
+                    if self.extractor is not None:
+                        self.extractor.write(data)
+                    received += len(data)
+                    count    += len(data)
+
+                    # Check the speed of the download every ten seconds
+                    if clock() - window >= 10:
+
+                        # And give up if it's too slow
+                        if count / (clock() - window) < stall:
+                            raise OSError(ETIMEDOUT, 'The download from {} stalled'.format(url))
+
+                        # Otherwise start measuring again
+                        window, count = clock(), 0
+
+            # Get the amount of data the server said it would send
+            length = response.headers.get('Content-Length')
+
+            # Check that the connection wasn't closed early
+            if length is not None and received < int(length):
+                raise IncompleteRead(b'', int(length) - received)
+
+        # And return the hash of the file
+        return hash, teed
+
+
+    def checksum(self, filename = None):
+        ''' A simple method which checks if the downloaded file has the correct
+            checksum and was not tampered with on the download.'''
+        # Check if the file was already verified while it was downloaded
+        if not filename and self.verified:
+            return True
+
+        # If the filename is not defined, use the copy in the store
+        if not filename:
+            filename = self.source
+
+        # Check if the file is unchanged since it was last verified
+        if self.parent.parent.manifest.lookup(filename, self.algorithm) == self.digest:
+            return True
+
+        # Check if our file matches
+        if self.hash(filename).hexdigest() != self.digest:
+            return False
+
+        # And remember that it does for next time
+        self.parent.parent.manifest.record(filename, self.algorithm, self.digest)
+        return True
+
+
+    def hash(self, filename, extractor = None):
+        ''' A method which hashes a file, if it exists. The file is read in
+            large blocks into a single buffer, and as hashlib releases the GIL
+            while it works, many files can be hashed at once by the pool. If an
+            extraction is given, the file is handed to it as it's read.'''
+        # Create the hash
+        hash = hasher(self.algorithm)
+
+        # Check that there is a file to hash
+        if path.isfile(filename):
+
+            # Create the buffer to read into
+            buffer = bytearray(Download.BUFFER)
+            view   = memoryview(buffer)
+
+            # Open the file to hash it
+            with open(filename, 'rb', buffering = 0) as file:
+
+                # Read the data in a loop
+                while True:
+
+                    # Read in a chunk of data
+                    size = file.readinto(buffer)
+
+                    # Check that that chunk is not empty
+                    if not size:
+                        break
+
+                    # And update our hash
+                    hash.update(view[:size])
+
+                    # And hand the data to the extraction, if there is one
+                    if extractor is not None:
+                        extractor.write(bytes(view[:size]))
+
+        # And return the hash
+        return hash
+
+
+    def copy(self):
+        ''' A simple method which places our downloaded archive into the build
+            systems' sources directory, sharing the copy in the store where
+            possible rather than copying it.'''
+        # Check that the file wasn't already written while it was downloaded
+        if self.copied:
+            return path.isfile(self.target)
+
+        # Check if the build system already has a good copy of the file, which
+        # isn't a link to the store left by an earlier version
+        if path.isfile(self.target) and not path.samefile(self.source, self.target) \
+                and self.parent.parent.manifest.lookup(self.target, self.algorithm) == self.digest:
+            return True
+
+        # Place the file in the build system, noting how it was done
+        self.method = clone(self.source, self.target)
+        self.parent.parent.manifest.record(self.target, self.algorithm, self.digest)
+
+        # And return if the file exists
+        return path.isfile(self.target)
+
+
+    def transcode(self):
+        ''' A method which keeps a copy of the archive recompressed with zstd,
+            which is much faster to decompress, if the settings ask for one.
+            The copy is kept under the checksum of the original, and is only
+            ever made from an original which has been verified.'''
+        # Check that a copy is wanted
+        if not self.parent.parent.transcode:
+            return True
+
+        # Get the original archive
+        archive = Archive(self.source, self.extension)
+
+        # Check that the copy can be made, and skip it if it can't
+        if not ('.tar' in self.extension or self.extension == '.tgz') \
+                or archive.program() is None or which('zstd') is None:
+            return True
+
+        # Check if the copy has already been made
+        if not path.isfile(self.zstd):
+
+            # Write to a partial file, so that the copy is never half written
+            with open(self.zstd + '.part', 'wb') as file:
+
+                # Decompress the original, and recompress it with zstd
+                reader = archive.decompress(PIPE)
+                writer = Popen(['zstd', '-T0', '-q', '-c'], stdin = reader.stdout,
+                               stdout = file, stderr = DEVNULL)
+
+                # Let the decompressor know if the compressor stops early
+                reader.stdout.close()
+
+                # And check that both of them worked
+                success = writer.wait() == 0 and reader.wait() == 0
+
+            # Check that the copy was made
+            if not success:
+
+                # If not, throw it away, and carry on with the original
+                deletefile(self.zstd + '.part')
+                return True
+
+            # And move it into place
+            rename(self.zstd + '.part', self.zstd)
+
+        # Check if the build system already has the copy
+        if not path.isfile(self.transcoded):
+
+            # Make sure there's somewhere to put the copy
+            makedirs(path.dirname(self.transcoded), exist_ok = True)
+
+            # And place it in the build system
+            clone(self.zstd, self.transcoded)
+
+        # And return that everything went well
+        return True
+
+
+
+from lzma import LZMAError
+from os import fdopen, pipe, sep
+from shutil import rmtree
+from zlib import error as ZlibError
+
+import fcntl
+import tarfile
+
+class Extractor(Thread):
+    ''' The extractor class. This unpacks an archive from the data handed to it
+        while the archive is still downloading, into a staging directory beside
+        the build system's sources. The extracted tree is only kept once the
+        checksum of the whole archive is known to be good.'''
+
+
+    # The size of the pipe between the download and the extraction
+    PIPE = 1048576
+
+
+    def __init__(self, directory, owner = None):
+        ''' The constructor. This creates the pipe which the archive is written
+            into, and starts reading from it. If an owner is given, each of the
+            files is given to them as it's written.'''
+        # Create the thread
+        Thread.__init__(self, daemon = True)
+
+        # Store where the tree goes once it's good, and where it's built
+        self.directory = directory
+        self.staging   = directory + '.part'
+
+        # Store who the files are given to
+        self.owner     = owner
+
+        # Create the pipe which carries the archive
+        input, output = pipe()
+
+        try:
+            # Make the pipe larger, so that the download isn't held up
+            fcntl.fcntl(output, getattr(fcntl, 'F_SETPIPE_SZ', 1031), Extractor.PIPE)
+
+        # This is thrown if the pipe can't be resized
+        except OSError:
+            pass
+
+        # Open both ends of the pipe
+        self.input  = fdopen(input, 'rb')
+        self.output = fdopen(output, 'wb')
+
+        # Note that the extraction hasn't finished
+        self.result = False
+        self.broken = False
+
+        # And start extracting
+        self.start()
+
+
+    def run(self):
+        ''' A method which extracts each member of the archive as it arrives.'''
+        try:
+            # Clear any left-over tree
+            if path.isdir(self.staging):
+                rmtree(self.staging)
+
+            # Create the directory for the extraction
+            makedirs(self.staging)
+
+            # Store the directories, whose details are set once they're filled
+            directories = list()
+
+            # Open the archive as a stream, whatever its compression
+            with tarfile.open(fileobj = self.input, mode = 'r|*') as archive:
+
+                # Iterate through each of the members as they arrive
+                for member in archive:
+
+                    # Check that the member stays inside the tree
+                    if not self.contained(member):
+                        raise tarfile.TarError('{} is outside of the archive'.format(member.name))
+
+                    # Note the member if it's a directory
+                    if member.isdir():
+                        directories.append(member)
+
+                    # Check if the member should be given to someone
+                    if self.owner is not None:
+
+                        # And give it to them
+                        member.uid, member.gid = self.owner
+                        member.uname, member.gname = '', ''
+
+                    # And extract it, leaving directories writable until the end
+                    archive.extract(member, self.staging, set_attrs = not member.isdir(),
+                                    numeric_owner = self.owner is not None)
+
+                # Iterate through each of the directories, deepest first, in the
+                # same way as extracting the whole archive would
+                for member in sorted(directories, key = lambda member: member.name, reverse = True):
+
+                    # Get where the directory was extracted to
+                    target = path.join(self.staging, member.name)
+
+                    try:
+                        # And set its owner, times and permissions
+                        archive.chown(member, target, self.owner is not None)
+                        archive.utime(member, target)
+                        archive.chmod(member, target)
+
+                    # This is thrown if the details can't be set, which isn't fatal
+                    except tarfile.ExtractError:
+                        pass
+
+            # Note that the whole archive was extracted
+            self.result = True
+
+        # This is thrown if the archive is damaged or incomplete
+        except (tarfile.TarError, EOFError, OSError, LZMAError, ZlibError):
+            self.result = False
+
+        finally:
+
+            # Read whatever is left, so that the download is never held up
+            while self.input.read(Extractor.PIPE):
+                pass
+
+            # And close our end of the pipe
+            self.input.close()
+
+
+    def contained(self, member):
+        ''' A method which checks that a member of the archive, and anything
+            that it links to, is inside the staging directory.'''
+        # Get the real location of the staging directory
+        root = path.realpath(self.staging)
+
+        # Work out where the member is really placed
+        parent = path.realpath(path.dirname(path.join(root, member.name)))
+        places = [parent]
+
+        # Work out where a symbolic link really points
+        if member.issym():
+            places.append(path.realpath(path.join(parent, member.linkname)))
+
+        # Work out where a hard link really points
+        elif member.islnk():
+            places.append(path.realpath(path.join(root, member.linkname)))
+
+        # And check that each of them is inside the tree
+        return all(place == root or place.startswith(root + sep) for place in places)
+
+
+    def write(self, data):
+        ''' A method which hands the next part of the archive to the extraction.'''
+        # Check that the extraction can still take data
+        if self.broken:
+            return
+
+        try:
+            # Write the data into the pipe
+            self.output.write(data)
+
+        # This is thrown if the extraction has gone away
+        except OSError:
+            self.broken = True
+
+
+    def finish(self):
+        ''' A method which marks the end of the archive, and waits for the
+            extraction to catch up.'''
+        try:
+            # Close our end of the pipe
+            self.output.close()
+
+        # This is thrown if the last of the data couldn't be written
+        except OSError:
+            self.broken = True
+
+        # And wait for the extraction to finish
+        self.join()
+
+
+    def promote(self, success):
+        ''' A method which moves the extracted tree into place if the archive
+            was good, and throws it away otherwise.'''
+        # Make sure that the extraction has finished
+        self.finish()
+
+        # Check that both the archive and the extraction were good
+        if success and self.result and not self.broken:
+
+            # Clear any older tree
+            if path.isdir(self.directory):
+                rmtree(self.directory)
+
+            # And move the tree into place
+            rename(self.staging, self.directory)
+            return True
+
+        # Otherwise throw the tree away
+        rmtree(self.staging, ignore_errors = True)
+        return False
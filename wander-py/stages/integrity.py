@@ -0,0 +1,219 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from os import cpu_count
+from util import Output
+
+
+class Integrity:
+    ''' The class responsible for checking that each of the archives and patches
+        which the build uses is intact before the build starts, so that a bad
+        file is found in minutes rather than hours into the build. Each archive
+        is read through to its end, and each patch is tried against the files
+        that it changes, with the archives checked in parallel.'''
+
+
+    def __init__(self, downloader, stages):
+        ''' The constructor. This collects the archives and patches used by
+            each of the modules of the stages which are being built.'''
+        # Store the downloader, which has the archives and patches
+        self.downloader = downloader
+
+        # Store the names of the stages being checked
+        self.names      = ', '.join(stage.stage[0].lower() for stage in stages)
+
+        # Store the patches applied to each archive, in the order they're used
+        self.packages   = dict()
+
+        # Iterate through each of the modules in each of the stages
+        for stage in stages:
+            for element in stage.elements.values():
+
+                # Check that the module is built
+                if element.get('skip'):
+                    continue
+
+                # Add the module's archive, and its patch
+                self.packages.setdefault(element.get('package'), list())
+
+                if element.get('patch') is not None and \
+                        element.get('patch') not in self.packages[element.get('package')]:
+                    self.packages[element.get('package')].append(element.get('patch'))
+
+                # And add the archives of its sub-modules
+                for module in element.get('modules') or list():
+                    self.packages.setdefault(module, list())
+
+
+    def verify(self):
+        ''' A simple method which checks each of the archives in parallel, and
+            reports the results in the order that they're used.'''
+        # Tell the user what's happening
+        Output.header('Checking the packages and patches of {}...'.format(self.names))
+
+        # Store the result of the checks
+        result = True
+
+        # Create the pool which runs the checks
+        with ThreadPoolExecutor(max_workers = cpu_count() or 1) as pool:
+
+            # Create the checks, and start them all running
+            checks  = [Check(package, patches, self) for package, patches in self.packages.items()]
+            futures = [pool.submit(check.verify) for check in checks]
+
+            # Iterate through each of the checks in turn
+            for check, future in zip(checks, futures):
+
+                # Note that we've started the check
+                Output.log(Output.SCANNING, check.description)
+
+                # Wait for the check to finish
+                while True:
+
+                    try:
+                        # Get the result of the check
+                        success = future.result(timeout = 0.25)
+
+                        # And stop waiting
+                        break
+
+                    # This is thrown if the check is still running
+                    except TimeoutError:
+                        pass
+
+                # Add the result to our results variable
+                result &= success
+
+                # And tell the user how it went
+                Output.clear()
+                Output.log(Output.PASSED if success else Output.FAILED, check.description)
+
+                # Along with the reason, if it failed
+                if not success:
+                    print('')
+                    Output.text('    ' + check.reason, False)
+
+                # Add the final line of output
+                print('')
+
+        # Inform the user of the status
+        Output.footer(result, 'Checking the packages and patches of {}'.format(self.names))
+
+        # And return the result
+        return result
+
+
+
+from archive import Archive
+from os import path
+from shutil import which
+from subprocess import PIPE, STDOUT, run
+from tempfile import TemporaryDirectory
+
+import tarfile
+
+class Check:
+    ''' The check class, which checks a single archive and the patches which
+        are applied to it.'''
+
+
+    def __init__(self, package, patches, parent):
+        ''' The init method, used to create a new check of an archive and its
+            patches.'''
+        # Store the names of the archive and the patches
+        self.package = package
+        self.patches = patches
+
+        # Store the downloads of the archive and the patches
+        self.download = parent.downloader.packages.downloads[package]
+        self.fixes    = [parent.downloader.patches.downloads[patch] for patch in patches]
+
+        # Store the information about the archive
+        self.description = self.download.description
+
+        # Store the system which runs the checks
+        self.parent = parent
+
+        # Note why the check failed, if it does
+        self.reason = None
+
+
+    def verify(self):
+        ''' A method which checks that the archive is intact and has a single
+            top folder, and that each of the patches still applies to it.'''
+        # Make sure that the archive and patches have been downloaded
+        if not self.parent.downloader.wait([self.package], self.patches):
+
+            # And stop if they couldn't be
+            self.reason = 'The files could not be downloaded'
+            return False
+
+        # Create somewhere to put the files that the patches change
+        with TemporaryDirectory() as directory:
+
+            try:
+                # Read through the archive, keeping the files that are patched
+                folders = Archive(self.download.target, self.download.extension) \
+                            .scan(directory, self.files())
+
+            # This is thrown if the archive is damaged
+            except (tarfile.TarError, EOFError, OSError, ValueError) as error:
+
+                # So note why the check failed
+                self.reason = 'The archive is damaged ({})'.format(error)
+                return False
+
+            # Check that the archive unpacks into a single folder
+            if len(folders) != 1:
+
+                # And note why the check failed if it doesn't
+                self.reason = 'The archive has {} top folders, not one'.format(len(folders))
+                return False
+
+            # Check that there is a way to try the patches
+            if self.fixes and which('patch') is None:
+                return True
+
+            # Try each of the patches
+            for fix in self.fixes:
+
+                # Check if the patch applies, without changing anything
+                process = run(['patch', '-Np1', '--dry-run', '--batch', '-i', path.abspath(fix.target)],
+                              cwd = directory, stdout = PIPE, stderr = STDOUT)
+
+                # And note why the check failed if it doesn't
+                if process.returncode != 0:
+                    self.reason = '{} does not apply: {}'.format(fix.description,
+                                    process.stdout.decode('utf-8', 'replace').strip().split('\n')[-1])
+                    return False
+
+        # And return that everything went well
+        return True
+
+
+    def files(self):
+        ''' A method which returns the files which the patches change, without
+            their top folder.'''
+        # Store the files that we find
+        files = set()
+
+        # Iterate through each of the patches
+        for fix in self.fixes:
+
+            # Open the patch to read it
+            with open(fix.target, 'r', errors = 'replace') as file:
+
+                # Iterate through each of the lines of the patch
+                for line in file:
+
+                    # Check that the line names a file which is changed
+                    if not line.startswith(('--- ', '+++ ')):
+                        continue
+
+                    # Get the name of the file, without any timestamp
+                    name = line[4:].split('\t')[0].strip()
+
+                    # And add it without its top folder
+                    if name != '/dev/null' and '/' in name:
+                        files.add(name.split('/', 1)[1])
+
+        # And return the files
+        return files
@@ -0,0 +1,144 @@
+from os import cpu_count, makedirs, O_RDONLY, open as openfd, path, rename, sysconf
+from platform import machine
+from threading import Lock
+from yaml import safe_dump as dump, safe_load as load, YAMLError
+
+
+class Tuner:
+    ''' The tuner class. This remembers how long each module took to build with
+        different numbers of jobs, and how much memory it needed, for each kind
+        of host that it was built on. When tuning, each module is built with
+        the number of jobs which it has been tried with least, and otherwise it
+        is built with the number which worked best.'''
+
+
+    # How much slower than the fastest a number of jobs may be and still be
+    # chosen, so that modules which gain little from more jobs leave them free
+    TOLERANCE = 1.05
+
+
+    def __init__(self, filename, jobs, tune = False):
+        ''' The constructor. This loads the results of earlier builds, and keeps
+            the folder that they're written to open, so that they can still be
+            saved from inside the chroot.'''
+        # Store where the results are kept
+        self.filename = filename
+
+        # Store the most jobs which can be used, and whether we're tuning
+        self.jobs     = jobs
+        self.tune     = tune
+
+        # Work out what kind of host this is, by its cores and memory
+        self.memory   = sysconf('SC_PHYS_PAGES') * sysconf('SC_PAGE_SIZE') // 1024
+        self.host     = '{}-{}c-{}g'.format(machine(), cpu_count() or 1,
+                                            round(self.memory / 1048576))
+
+        # Create the record of each module
+        self.hosts    = dict()
+        self.lock     = Lock()
+
+        # Check that there are results to load
+        if path.isfile(self.filename):
+
+            # Load the YAML file
+            with open(self.filename, 'r') as stream:
+
+                # Read from the stream
+                try:
+
+                    # Store the file contents
+                    self.hosts = load(stream) or dict()
+
+                # If the results are damaged, we'll simply measure again
+                except YAMLError:
+                    pass
+
+        try:
+            # Open the folder which holds the results
+            makedirs(path.dirname(self.filename), exist_ok = True)
+            self.directory = openfd(path.dirname(self.filename), O_RDONLY)
+
+        # This is thrown if the folder can't be used, so nothing is saved
+        except OSError:
+            self.directory = None
+
+
+    def levels(self):
+        ''' A method which returns the numbers of jobs that are tried, doubling
+            each time up to the most that can be used.'''
+        # Store the numbers of jobs
+        levels = [1]
+
+        # Double the number of jobs until we reach the most that can be used
+        while levels[-1] * 2 < self.jobs:
+            levels.append(levels[-1] * 2)
+
+        # And add the most that can be used
+        return levels + [self.jobs] if self.jobs > 1 else levels
+
+
+    def level(self, module):
+        ''' A method which returns the number of jobs to build a module with, or
+            None if nothing is known about the module.'''
+        # Get the results of the module on this kind of host
+        with self.lock:
+            records = dict((self.hosts.get(self.host) or dict()).get(module) or dict())
+
+        # Check if we're tuning
+        if self.tune:
+
+            # And try the number of jobs which has been tried least, most first
+            return min(self.levels(), key = lambda level: ((records.get(level) or dict())
+                                                           .get('runs', 0), -level))
+
+        # Get the numbers of jobs which don't need more memory than there is
+        levels = {level: record for level, record in records.items()
+                    if record.get('memory', 0) * level <= self.memory} or records
+
+        # Check that the module has been built before
+        if not levels:
+            return None
+
+        # Get the fastest time that the module was built in
+        fastest = min(record.get('time') for record in levels.values())
+
+        # And return the fewest jobs which were about as fast
+        return min(min(level for level, record in levels.items()
+                        if record.get('time') <= fastest * Tuner.TOLERANCE), self.jobs)
+
+
+    def record(self, module, level, time, memory):
+        ''' A method which records how long a module took to build with a number
+            of jobs, and the most memory that any of its processes used.'''
+        # Make sure only one thread changes the records at a time
+        with self.lock:
+
+            # Get the existing record of the module
+            records = self.hosts.setdefault(self.host, dict()).setdefault(module, dict())
+            record  = records.setdefault(level, {'runs': 0, 'time': 0, 'memory': 0})
+
+            # Add the build to the average time, and the most memory used
+            record['runs']  += 1
+            record['time']   = round(record['time'] + (time - record['time']) / record['runs'], 2)
+            record['memory'] = max(record['memory'], memory)
+
+
+    def save(self):
+        ''' A method which writes the results to the disk.'''
+        # Check that there's somewhere to write them
+        if self.directory is None:
+            return
+
+        # Get the name of the file, within its folder
+        name = path.basename(self.filename)
+
+        # Make sure only one thread writes the results at a time
+        with self.lock:
+
+            # Write to a temporary file, so that the results are never half written
+            with open(name + '.part', 'w', opener = lambda file, flags:
+                        openfd(file, flags, 0o644, dir_fd = self.directory)) as stream:
+                dump(self.hosts, stream)
+
+            # And move it into place
+            rename(name + '.part', name, src_dir_fd = self.directory, dst_dir_fd = self.directory)
@@ -33,6 +33,7 @@ class Output:
     DOWNLOADING = B_BLUE    + 'Downloading'
     VERIFYING   = B_BLUE    + 'Verifying'
     COPYING     = B_BLUE    + 'Copying'
+    TRANSCODING = B_BLUE    + 'Transcoding'
     EXTRACTING  = B_BLUE    + 'Extracting'
     PATCHING    = B_BLUE    + 'Patching'
     SETUP       = B_BLUE    + 'Setting up'
@@ -44,6 +45,7 @@ class Output:
     VALIDATING  = B_BLUE    + 'Validating'
     CLEANING    = B_BLUE    + 'Cleaning'
     EXECUTING   = B_BLUE    + 'Executing'
+    BUILDING    = B_BLUE    + 'Building'
     PASSED      = B_GREEN   + 'Passed'
     FAILED      = B_RED     + 'Failed'
 
@@ -100,9 +102,10 @@ class Output:
 
 
 from getpass import getuser
-from os import setgid, setuid
+from os import close, geteuid, getgrouplist, pipe, wait4, waitstatus_to_exitcode, write
 from pwd import getpwnam
 from subprocess import Popen, PIPE, STDOUT
+from threading import local
 
 
 class Commands:
@@ -119,6 +122,17 @@ class Commands:
                       'chroot',
                       'default'}
 
+        # Store the pool of jobs shared by each make, if there is one
+        self.jobserver = None
+
+        # Store the cgroups which modules are built in, if they're used
+        self.cgroups   = None
+
+        # Store the details kept for each thread, such as the pool of jobs and
+        # the cgroup that a module was given, and the most memory that its
+        # commands used
+        self.local     = local()
+
         # And upate the list of users
         self.update()
 
@@ -160,53 +174,105 @@ class Commands:
         # Store information about the user that we'll be running commands as
         user = self.USERS.get(user)
 
+        # Work on a copy of the environment, as commands may run at the same time
+        environment = dict(environment)
+
         # Do some work on the environment
         environment['HOME']    = user.pw_dir
         environment['LOGNAME'] = user.pw_name
         environment['USER']    = user.pw_name
 
-        # Store the raw output of the command
+        # Store the files which the command shares with us
+        descriptors = tuple()
+
+        # Get the pool of jobs to share with make, preferring the module's own
+        jobserver = getattr(self.local, 'jobserver', None) or self.jobserver
+
+        # Check if there is a pool of jobs to share with make
+        if jobserver is not None:
+
+            # And tell make how to find it
+            environment['MAKEFLAGS'] = (environment.get('MAKEFLAGS', '') + ' ' +
+                                        jobserver.flags()).strip()
+            descriptors = (jobserver.input, jobserver.output)
+
+        # Get the cgroup to build in, if the module was given one
+        cgroup = getattr(self.local, 'cgroup', None)
+
+        # Check if the command should be run in a cgroup
+        if cgroup is not None:
+
+            # Create a pipe which holds the command back until it's been moved
+            # into the cgroup, so that nothing that it starts is left outside
+            gate        = pipe()
+            command     = 'read -r -u {0} _; exec {0}<&-; '.format(gate[0]) + command
+            descriptors = descriptors + (gate[0],)
+
+        # Set the last environment variable, if there's a directory to run in
         if directory is not None:
-            # Set the last environment variable
-            environment['PWD']  = directory
+            environment['PWD'] = directory
 
-            # And prepare the subprocess system
+        try:
+            # Prepare the subprocess system, as the user, and with their groups
+            # if we're allowed to change them
             process = Popen(command, shell=True, env=environment,
-                            preexec_fn=self.demote(user.pw_uid, user.pw_gid),
+                            user=user.pw_uid,
+                            group=user.pw_gid,
+                            extra_groups=getgrouplist(user.pw_name, user.pw_gid)
+                                            if geteuid() == 0 else None,
+                            pass_fds=descriptors,
                             stdout=PIPE,
                             stderr=STDOUT,
                             cwd=directory,
                             executable='bash')
 
-        else:
-            # Prepare the subprocess system
-            process = Popen(command, shell=True, env=environment,
-                            preexec_fn=self.demote(user.pw_uid, user.pw_gid),
-                            stdout=PIPE,
-                            stderr=STDOUT,
-                            executable='bash')
+            # Move the command into the cgroup
+            if cgroup is not None:
+                cgroup.enter(process.pid)
+
+        finally:
+
+            # And let it carry on
+            if cgroup is not None:
+                close(gate[0])
+
+                try:
+                    write(gate[1], b'\n')
+
+                # This is thrown if the command was never started
+                except OSError:
+                    pass
+
+                close(gate[1])
 
         # Get the stdout and stderr from the command
-        stdout, stderr = process.communicate(command)
+        stdout, stderr = process.stdout.read(), None
+        process.stdout.close()
+
+        # Wait for the command to finish, getting what it used
+        _, status, usage = wait4(process.pid, 0)
+
+        # And store how it finished, in the same way as subprocess would
+        process.returncode = waitstatus_to_exitcode(status)
+
+        # And note the most memory that any of its processes used
+        self.local.peak = max(getattr(self.local, 'peak', 0), usage.ru_maxrss)
 
         # Return the results of the command
         return stdout, stderr
 
 
-    def demote(self, uid, gid):
-        ''' A method which 'demotes' the system to a specified user, so that
-            commands can be run properly as that user.'''
+    def measure(self):
+        ''' A method which returns the most memory, in kilobytes, used by any of
+            the commands run on this thread since it was last measured.'''
+        # Get the most memory used
+        peak = getattr(self.local, 'peak', 0)
 
-        def result():
-            ''' The result method, which actually updates the uid and gid of the
-                system.'''
-            # Update the values using methods from the os package
-            setgid(gid)
-            setuid(uid)
-
-        # And return the method which changes the user
-        return result
+        # Start measuring again
+        self.local.peak = 0
 
+        # And return it
+        return peak
 
 
 from exception import CommandException
@@ -385,6 +451,102 @@ class Logger:
             file.write('\n   *****   \n')
 
 
+from fcntl import ioctl
+from os import fstat, remove, sendfile
+from shutil import copyfileobj
+
+try:
+    # This is only available in newer versions of python
+    from os import copy_file_range
+
+except ImportError:
+    copy_file_range = None
+
+# The ioctl which asks the filesystem to share the blocks of one file with another
+FICLONE = 0x40049409
+
+def clone(source, target):
+    ''' A method which makes a file available at a new location as cheaply as
+        possible. A reflink is tried first, then a copy inside the kernel, and
+        finally a normal copy. Hardlinks are never used, as the build changes
+        the owner of its sources, which would change the source as well. The
+        name of the method which worked is returned.'''
+    # Check if there's an old file in the way
+    if path.lexists(target):
+
+        # Remove it, so that we never write through a link to the source
+        remove(target)
+
+    # Open both of the files
+    with open(source, 'rb') as input, open(target, 'wb') as output:
+
+        try:
+            # Try to share the blocks of the source with the target
+            ioctl(output.fileno(), FICLONE, input.fileno())
+
+            # And return what we did
+            return 'reflink'
+
+        # This is thrown if the filesystem can't share blocks
+        except OSError:
+            pass
+
+    # Open both of the files again
+    with open(source, 'rb') as input, open(target, 'wb') as output:
+
+        # Store the size of the file
+        size = fstat(input.fileno()).st_size
+
+        # Try each of the ways of copying inside the kernel
+        for method in ('copy_file_range', 'sendfile'):
+
+            # Check that this way of copying is available
+            if method == 'copy_file_range' and copy_file_range is None:
+                continue
+
+            # Start from the beginning of the file
+            offset = 0
+
+            try:
+                # Copy the file in a loop
+                while offset < size:
+
+                    # Copy in a chunk of data
+                    if method == 'copy_file_range':
+                        copied = copy_file_range(input.fileno(), output.fileno(), size - offset, offset, offset)
+
+                    else:
+                        copied = sendfile(output.fileno(), input.fileno(), offset, size - offset)
+
+                    # Check that something was copied
+                    if copied == 0:
+                        break
+
+                    # And move on
+                    offset += copied
+
+                # Check that the whole file was copied
+                if offset == size:
+
+                    # And return what we did
+                    return method
+
+            # This is thrown if the kernel can't copy between these files
+            except OSError:
+                pass
+
+        # Start the copy again from scratch
+        input.seek(0)
+        output.seek(0)
+        output.truncate()
+
+        # And copy the file ourselves
+        copyfileobj(input, output, 1048576)
+
+    # And return what we did
+    return 'copy'
+
+
 def docker():
     ''' A method which checks whether or not we are running in a docker
         instance. This is important, as we cannot partition or do anything